@@ -0,0 +1,52 @@
+'''
+Counts the SQL statements the DataProcessor runs per request.
+
+Usage: python -m benchmarks.registration_statements
+'''
+import os
+import tempfile
+
+from lib.dataprocessor import DataProcessor, IdentityCache
+from lib.migrations import MigrationRunner
+
+
+USER = {'username': 'benchmark', 'full_name': 'Benchmark User'}
+CHAT_ID = -100
+
+
+def count_statements(database: str, action) -> int:
+    '''
+    Run action against a fresh DataProcessor (cold identity cache) and count its statements.
+    '''
+    dp = DataProcessor(database, identities=IdentityCache())
+    statements = 0
+
+    def trace(cursor, sql, bindings):
+        nonlocal statements
+        statements += 1
+        return True
+
+    dp.con.exec_trace = trace
+    try:
+        action(dp)
+    finally:
+        dp.con.exec_trace = None
+        dp.close()
+    return statements
+
+
+def main():
+    database = os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+    MigrationRunner(database).run()
+
+    cases = [
+        ('new user and chat', lambda dp: dp.get_userchat_id(USER, CHAT_ID, 'group')),
+        ('known user and chat', lambda dp: dp.get_userchat_id(USER, CHAT_ID, 'group')),
+        ('log new image', lambda dp: dp.log_new_image(USER, CHAT_ID, 'benchmark.png', 'prompt', 'new', 'group')),
+    ]
+    for name, action in cases:
+        print(f'{name}: {count_statements(database, action)} statements')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,10 +4,6 @@
 mkdir -p /app/data/sqlite
 mkdir -p /app/data/images
 
-if [ ! -f /app/data/sqlite/dilly-dalle-sd.db ]; then
-    python -c "import sqlite3; conn = sqlite3.connect('/app/data/sqlite/dilly-dalle-sd.db'); cur = conn.cursor(); cur.executescript(open('schema.sql', 'r').read()); conn.commit(); conn.close();"
-else
-    echo "SQLite database already exists."
-fi
+# The database schema is created and migrated by the bot on startup
 
 exec python main.py
\ No newline at end of file
@@ -0,0 +1,131 @@
+import logging
+import re
+import threading
+from collections import OrderedDict
+
+
+MARKER = '%'
+
+
+class AliasExpansionError(ValueError):
+    '''
+    Raised when a prompt grows past the size cap while expanding aliases.
+    '''
+
+
+class AliasExpander:
+    '''
+    Compiled alias table of one userchat.
+    Nested aliases are resolved once up front (an alias that would refer back
+    to itself is left as written), so a prompt is expanded in a single regex pass.
+    '''
+    def __init__(self, aliases: dict, max_length: int = 2000):
+        self.max_length = max_length
+        self.logger = logging.getLogger(__name__)
+
+        self.aliases = aliases
+        self.pattern = self.__compile(aliases)
+        self.resolved = {}
+        for alias in aliases:
+            try:
+                self.__resolve(alias, [])
+            except AliasExpansionError as e:
+                # Oversized aliases stay unresolved and fail the prompts that use them
+                self.logger.warning(str(e))
+
+    ###########
+    # Helpers #
+    ###########
+
+    def __compile(self, aliases: dict):
+        '''
+        One alternation of every alias, longest first; an alias ends where a word would
+        (whitespace, trailing punctuation or the end of the text).
+        '''
+        if not aliases:
+            return None
+        names = sorted((re.escape(alias) for alias in aliases), key=len, reverse=True)
+        return re.compile(f"{re.escape(MARKER)}({'|'.join(names)})(?=[\\s.,!?]|$)")
+
+    def __resolve(self, alias: str, stack: list) -> str:
+        '''
+        Fully expand an alias, leaving cyclic references unexpanded.
+        '''
+        if alias in self.resolved:
+            return self.resolved[alias]
+
+        stack.append(alias)
+
+        def replace(match):
+            name = match.group(1)
+            if name in stack:
+                self.logger.debug(f'Alias cycle: {" -> ".join(stack + [name])}')
+                return match.group(0)
+            return self.__resolve(name, stack)
+
+        text = self.pattern.sub(replace, self.aliases[alias])
+        stack.pop()
+
+        if len(text) > self.max_length:
+            raise AliasExpansionError(f'Alias {alias} expands to more than {self.max_length} characters')
+        self.resolved[alias] = text
+        return text
+
+    def __lookup(self, match) -> str:
+        alias = match.group(1)
+        if alias not in self.resolved:
+            raise AliasExpansionError(f'Alias {alias} expands to more than {self.max_length} characters')
+        return self.resolved[alias]
+
+    ##################
+    # Public methods #
+    ##################
+
+    def expand(self, text: str) -> str:
+        '''
+        Replace every alias in text with its expansion.
+        '''
+        if self.pattern is None:
+            return text
+        expanded = self.pattern.sub(self.__lookup, text)
+        if len(expanded) > self.max_length:
+            raise AliasExpansionError(f'Prompt expands to more than {self.max_length} characters')
+        return expanded
+
+
+class AliasRegistry:
+    '''
+    Bounded LRU of compiled alias tables keyed by userchat_id.
+    Entries are dropped whenever the userchat's aliases change.
+    '''
+    def __init__(self, max_size: int = 256, max_length: int = 2000):
+        self.max_size = max_size
+        self.max_length = max_length
+        self.expanders = OrderedDict()
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def get(self, userchat_id: int, load) -> AliasExpander:
+        '''
+        The compiled aliases of a userchat; load returns its (alias, replacement) rows on a miss.
+        '''
+        with self.lock:
+            expander = self.expanders.get(userchat_id)
+            if expander is not None:
+                self.expanders.move_to_end(userchat_id)
+                return expander
+            version = self.versions.get(userchat_id, 0)
+
+        expander = AliasExpander(dict(load() or []), self.max_length)
+        with self.lock:
+            # Don't cache a table that changed while it was being loaded
+            if self.versions.get(userchat_id, 0) == version:
+                self.expanders[userchat_id] = expander
+                while len(self.expanders) > self.max_size:
+                    self.expanders.popitem(last=False)
+        return expander
+
+    def invalidate(self, userchat_id: int):
+        with self.lock:
+            self.expanders.pop(userchat_id, None)
+            self.versions[userchat_id] = self.versions.get(userchat_id, 0) + 1
@@ -5,6 +5,8 @@ from telegram import Update, User
 
 
 from .async_handlers import *
+from .migrations import MigrationRunner
+from .worker import GenerationWorker
 
 class App():
 
@@ -13,6 +15,45 @@ class App():
         self.telegram_bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
         self.stable_diffusion_url = os.environ.get('STABLE_DIFFUSION_URL')
         self.steps = os.environ.get('STEPS')
+        self.sd_timeout = os.environ.get('SD_TIMEOUT', '300')
+        self.sd_concurrency = os.environ.get('SD_CONCURRENCY', '1')
+        self.queue_size = os.environ.get('QUEUE_SIZE', '50')
+        self.health_check_interval = os.environ.get('HEALTH_CHECK_INTERVAL', '30')
+        self.max_images = os.environ.get('MAX_IMAGES', '4')
+        self.result_cache_entries = os.environ.get('RESULT_CACHE_ENTRIES', '500')
+        self.result_cache_mb = os.environ.get('RESULT_CACHE_MB', '500')
+        self.image_store_mb = os.environ.get('IMAGE_STORE_MB', '0')
+        self.delivery_format = os.environ.get('DELIVERY_FORMAT', 'jpeg')
+        self.delivery_quality = os.environ.get('DELIVERY_QUALITY', '90')
+        self.encode_workers = os.environ.get('ENCODE_WORKERS', '2')
+        self.download_timeout = os.environ.get('DOWNLOAD_TIMEOUT', '30')
+        self.max_download_mb = os.environ.get('MAX_DOWNLOAD_MB', '10')
+        self.source_cache_entries = os.environ.get('SOURCE_CACHE_ENTRIES', '32')
+        self.source_cache_disk_entries = os.environ.get('SOURCE_CACHE_DISK_ENTRIES', '256')
+        self.gen_log_buffer_size = os.environ.get('GEN_LOG_BUFFER_SIZE', '0')
+        self.gen_log_flush_interval = os.environ.get('GEN_LOG_FLUSH_INTERVAL', '5')
+        self.db_readers = os.environ.get('DB_READERS', '2')
+        self.webhook_url = os.environ.get('WEBHOOK_URL')
+        self.webhook_listen = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+        self.webhook_port = os.environ.get('WEBHOOK_PORT', '8443')
+        self.webhook_path = os.environ.get('WEBHOOK_PATH', 'telegram')
+        self.webhook_secret_token = os.environ.get('WEBHOOK_SECRET_TOKEN')
+        self.webhook_max_connections = os.environ.get('WEBHOOK_MAX_CONNECTIONS', '40')
+        self.role = os.environ.get('ROLE', 'all').lower()
+        self.worker_poll_interval = os.environ.get('WORKER_POLL_INTERVAL', '1')
+        self.job_lease = os.environ.get('JOB_LEASE', '60')
+        self.job_max_attempts = os.environ.get('JOB_MAX_ATTEMPTS', '3')
+        self.job_max_age = os.environ.get('JOB_MAX_AGE', '3600')
+        self.user_rate_limit = os.environ.get('USER_RATE_LIMIT', '20')
+        self.user_burst = os.environ.get('USER_BURST', '8')
+        self.chat_rate_limit = os.environ.get('CHAT_RATE_LIMIT', '60')
+        self.chat_burst = os.environ.get('CHAT_BURST', '20')
+        self.global_rate_limit = os.environ.get('GLOBAL_RATE_LIMIT', '0')
+        self.global_burst = os.environ.get('GLOBAL_BURST', '50')
+        self.rate_limit_save_interval = os.environ.get('RATE_LIMIT_SAVE_INTERVAL', '60')
+        self.vip_users = os.environ.get('VIP_USERS', '')
+        self.draft_steps = os.environ.get('DRAFT_STEPS', '10')
+        self.priority_aging = os.environ.get('PRIORITY_AGING', '30')
         self.loglevel = os.environ.get('LOGLEVEL')
         self.database = os.environ.get('DATABASE_URL')
 
@@ -22,17 +63,58 @@ class App():
     def start(self):
         logging.debug('Starting bot')
 
-        application = Application.builder().token(self.telegram_bot_token).build()
-        # application = updater.application
+        # Bring the database schema up to date before anything opens it
+        schema_version = MigrationRunner(self.database).run()
+        logging.debug(f'Database schema at version {schema_version}')
 
+        if self.role == 'worker':
+            self.__run_worker()
+            return
+        if self.role not in ('all', 'bot'):
+            raise ValueError(f'Unknown ROLE {self.role}, use all, bot or worker')
 
         # Create handler
         command_handler = RequestHandler(
             database_path=self.database,
-            stable_diffusion_url=self.stable_diffusion_url,
-            steps=self.steps
+            stable_diffusion_urls=[url.strip() for url in self.stable_diffusion_url.split(',') if url.strip()],
+            steps=self.steps,
+            sd_timeout=float(self.sd_timeout),
+            sd_concurrency=int(self.sd_concurrency),
+            queue_size=int(self.queue_size),
+            health_check_interval=float(self.health_check_interval),
+            max_images=int(self.max_images),
+            result_cache_entries=int(self.result_cache_entries),
+            result_cache_bytes=int(self.result_cache_mb) * 1024 * 1024,
+            image_store_bytes=int(self.image_store_mb) * 1024 * 1024,
+            delivery_format=self.delivery_format,
+            delivery_quality=int(self.delivery_quality),
+            encode_workers=int(self.encode_workers),
+            download_timeout=float(self.download_timeout),
+            max_download_bytes=int(self.max_download_mb) * 1024 * 1024,
+            source_cache_entries=int(self.source_cache_entries),
+            source_cache_disk_entries=int(self.source_cache_disk_entries),
+            gen_log_buffer_size=int(self.gen_log_buffer_size),
+            gen_log_flush_interval=float(self.gen_log_flush_interval),
+            db_readers=int(self.db_readers),
+            use_workers=self.role == 'bot',
+            job_max_age=float(self.job_max_age),
+            job_max_attempts=int(self.job_max_attempts),
+            rate_limits={
+                'user': (float(self.user_rate_limit), int(self.user_burst)),
+                'chat': (float(self.chat_rate_limit), int(self.chat_burst)),
+                'global': (float(self.global_rate_limit), int(self.global_burst)),
+            },
+            rate_limit_save_interval=float(self.rate_limit_save_interval),
+            vip_users=[user.strip() for user in self.vip_users.split(',') if user.strip()],
+            draft_steps=int(self.draft_steps),
+            priority_aging=float(self.priority_aging)
         )
 
+        # Updates are handled concurrently so queued generations don't hold up other chats
+        application = Application.builder().token(self.telegram_bot_token).concurrent_updates(True).post_init(command_handler.startup).post_shutdown(command_handler.shutdown).build()
+        # application = updater.application
+
+
         # Create handlers
         start_handler = CommandHandler('start', command_handler.start_command_handler)
         # help_handler = CommandHandler('help', command_handler.help_command_handler)
@@ -44,6 +126,7 @@ class App():
         photo_filter_handler = (MessageHandler(filters.PHOTO, command_handler.photo_filter_handler)) # Needed for photos sent directly with /variation in the caption
         variation_reply_handler = CommandHandler('variation', command_handler.variation_command_handler) # Needed for /variation as a reply to a photo
         safemode_handler = CommandHandler('safemode', command_handler.safemode_command_handler)
+        again_handler = CommandHandler('again', command_handler.again_command_handler)
 
         # Add handlers to application
         application.add_handler(start_handler)
@@ -56,8 +139,57 @@ class App():
         application.add_handler(photo_filter_handler)
         application.add_handler(variation_reply_handler)
         application.add_handler(safemode_handler)
+        application.add_handler(again_handler)
         
 
         # Start the bot
-        application.run_polling()
+        if self.webhook_url:
+            self.__run_webhook(application)
+        else:
+            application.run_polling()
         logging.debug('Bot started')
+
+    def __run_worker(self):
+        '''
+        Render jobs queued by a bot running with ROLE=bot.
+        '''
+        worker = GenerationWorker(
+            bot_token=self.telegram_bot_token,
+            database_path=self.database,
+            stable_diffusion_urls=[url.strip() for url in self.stable_diffusion_url.split(',') if url.strip()],
+            sd_timeout=float(self.sd_timeout),
+            sd_concurrency=int(self.sd_concurrency),
+            health_check_interval=float(self.health_check_interval),
+            result_cache_entries=int(self.result_cache_entries),
+            result_cache_bytes=int(self.result_cache_mb) * 1024 * 1024,
+            delivery_format=self.delivery_format,
+            delivery_quality=int(self.delivery_quality),
+            encode_workers=int(self.encode_workers),
+            db_readers=int(self.db_readers),
+            poll_interval=float(self.worker_poll_interval),
+            lease_seconds=float(self.job_lease),
+            max_attempts=int(self.job_max_attempts),
+            max_age=float(self.job_max_age),
+            priority_aging=float(self.priority_aging)
+        )
+        asyncio.run(worker.run())
+
+    def __run_webhook(self, application: Application):
+        '''
+        Serve updates pushed by Telegram from the built-in webhook server.
+        Telegram sends the secret token with every update; requests without it are rejected.
+        '''
+        if not self.webhook_secret_token:
+            logging.warning('WEBHOOK_SECRET_TOKEN is not set, anyone who finds the webhook URL can post updates')
+
+        url_path = self.webhook_path.strip('/')
+        logging.info(f'Listening for webhook updates on {self.webhook_listen}:{self.webhook_port}/{url_path}')
+        application.run_webhook(
+            listen=self.webhook_listen,
+            port=int(self.webhook_port),
+            url_path=url_path,
+            webhook_url=f"{self.webhook_url.rstrip('/')}/{url_path}",
+            secret_token=self.webhook_secret_token or None,
+            max_connections=int(self.webhook_max_connections),
+            allowed_updates=Update.ALL_TYPES,
+        )
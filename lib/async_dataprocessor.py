@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .aliases import AliasRegistry
+from .dataprocessor import DataProcessor, IdentityCache
+
+
+class AsyncDataProcessor:
+    '''
+    Async facade over DataProcessor that keeps SQLite off the event loop.
+    Writes run on a single writer thread and reads on a small pool of reader
+    threads; every thread opens its own connection. The identity and alias
+    caches are shared by all connections.
+    '''
+    def __init__(self, database: str, readers: int = 2, buffer_size: int = 0):
+        self.database = database
+        self.buffer_size = max(0, int(buffer_size))
+        self.identities = IdentityCache()
+        self.aliases = AliasRegistry()
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self.readers = ThreadPoolExecutor(max_workers=max(1, int(readers)), thread_name_prefix='db-reader')
+
+        self.logger = logging.getLogger(__name__)
+
+    ###########
+    # Helpers #
+    ###########
+
+    def __connection(self, buffer_size: int = 0) -> DataProcessor:
+        '''
+        The DataProcessor of the current thread.
+        '''
+        dp = getattr(self.local, 'dp', None)
+        if dp is None:
+            dp = DataProcessor(self.database, identities=self.identities, aliases=self.aliases, buffer_size=buffer_size)
+            self.local.dp = dp
+            with self.connections_lock:
+                self.connections.append(dp)
+        return dp
+
+    async def __write(self, method: str, *args, **kwargs):
+        '''
+        Run a DataProcessor method on the writer thread.
+        '''
+        def run():
+            return getattr(self.__connection(self.buffer_size), method)(*args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self.writer, run)
+
+    async def __read(self, method: str, *args, **kwargs):
+        '''
+        Run a DataProcessor method on a reader thread.
+        '''
+        def run():
+            return getattr(self.__connection(), method)(*args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self.readers, run)
+
+    ##################
+    # Public methods #
+    ##################
+
+    async def log_new_image(self, user: dict, chat_id: int, image_name: str, prompt: str, image_type: str, chat_type: str, storage: str = None, job_id: int = None):
+        return await self.__write('log_new_image', user=user, chat_id=chat_id, image_name=image_name, prompt=prompt, image_type=image_type, chat_type=chat_type, storage=storage, job_id=job_id)
+
+    async def get_userchat_id(self, user: dict, chat_id: int, chat_type: str):
+        return await self.__write('get_userchat_id', user, chat_id, chat_type)
+
+    async def set_spoiler_status(self, user: dict, chat_id: int, spoiler_status: bool):
+        return await self.__write('set_spoiler_status', user, chat_id, spoiler_status)
+
+    async def get_spoiler_status(self, user: dict, chat_id: int, cached: bool = True):
+        return await self.__read('get_spoiler_status', user, chat_id, cached)
+
+    async def teach_alias(self, user: dict, chat_id: int, alias: str, replacement: str):
+        return await self.__write('teach_alias', user, chat_id, alias, replacement)
+
+    async def forget_alias(self, user: dict, chat_id: int, alias: str):
+        return await self.__write('forget_alias', user, chat_id, alias)
+
+    async def dump_aliases(self, user: dict, chat_id: int):
+        return await self.__read('dump_aliases', user, chat_id)
+
+    async def get_alias(self, user: dict, chat_id: int, alias: str):
+        return await self.__read('get_alias', user, chat_id, alias)
+
+    async def expand_aliases(self, user: dict, chat_id: int, text: str):
+        return await self.__read('expand_aliases', user, chat_id, text)
+
+    async def set_file_id(self, image_name: str, file_id: str):
+        return await self.__write('set_file_id', image_name, file_id)
+
+    async def get_last_image(self, user: dict, chat_id: int):
+        # Buffered gen_log rows only exist on the writer connection
+        if self.buffer_size:
+            return await self.__write('get_last_image', user, chat_id)
+        return await self.__read('get_last_image', user, chat_id)
+
+    async def eviction_candidates(self, limit: int):
+        return await self.__write('eviction_candidates', limit)
+
+    async def mark_evicted(self, paths: list):
+        return await self.__write('mark_evicted', paths)
+
+    async def enqueue_job(self, job, max_queued: int = None, worker: str = None):
+        return await self.__write('enqueue_job', job, max_queued, worker)
+
+    async def claim_job(self, worker: str, lease_seconds: float, aging: float = 0):
+        return await self.__write('claim_job', worker, lease_seconds, aging)
+
+    async def renew_job_lease(self, job_id: int, worker: str, lease_seconds: float):
+        return await self.__write('renew_job_lease', job_id, worker, lease_seconds)
+
+    async def set_job_state(self, job_id: int, state: str, error: str = None, effective_priority: int = None):
+        return await self.__write('set_job_state', job_id, state, error, effective_priority)
+
+    async def expire_jobs(self, max_age: float):
+        return await self.__write('expire_jobs', max_age)
+
+    async def unfinished_jobs(self):
+        return await self.__read('unfinished_jobs')
+
+    async def job_delivered(self, job_id: int):
+        # Buffered gen_log rows only exist on the writer connection
+        if self.buffer_size:
+            return await self.__write('job_delivered', job_id)
+        return await self.__read('job_delivered', job_id)
+
+    async def save_rate_limits(self, rows: list):
+        return await self.__write('save_rate_limits', rows)
+
+    async def load_rate_limits(self):
+        return await self.__read('load_rate_limits')
+
+    async def flush(self):
+        return await self.__write('flush')
+
+    async def close(self):
+        '''
+        Flush pending writes, stop the executors and close every connection.
+        '''
+        await self.flush()
+        self.writer.shutdown(wait=True)
+        self.readers.shutdown(wait=True)
+        with self.connections_lock:
+            for dp in self.connections:
+                try:
+                    dp.close()
+                except Exception as e:
+                    self.logger.error(f'Error closing database connection: {e}')
+            self.connections = []
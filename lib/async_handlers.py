@@ -1,12 +1,30 @@
-from telegram import Update, Message
+from telegram import Update, Message, ReplyParameters
+from telegram.error import TelegramError
 from telegram.ext import CallbackContext
 
-from .dataprocessor import DataProcessor
-from .stable_diffusion import StableDiffusion
-
-import requests
+from .async_dataprocessor import AsyncDataProcessor
+from .stable_diffusion import GenerationRequest
+from .backend_pool import BackendPool
+from .scheduler import JobScheduler, QueueFullError
+from .singleflight import SingleFlight
+from .result_cache import ResultCache
+from .aliases import AliasExpansionError
+from .image_store import ImageStore, SWEEP_INTERVAL
+from .delivery import DeliveryEncoder, ImageDelivery
+from .jobs import GenerationJob, RUNNING, DONE, FAILED
+from .preprocess import ImagePreprocessor, SourceImageError
+from .source_cache import SourceCache
+from .rate_limiter import RateLimiter
+from .priority import PriorityPolicy
+
+import asyncio
 import logging
-from io import BytesIO
+import math
+import os
+import re
+import socket
+import uuid
+from dataclasses import replace
 
 # @TODO: Actually implement value error handling for the username for aliases
 
@@ -17,11 +35,37 @@ Class to handle requests from the user using async functions.
 '''
 
 class RequestHandler:
-    def __init__(self, database_path: str, stable_diffusion_url: str, steps: int):
-        self.database = DataProcessor(database_path)
-        self.sd = StableDiffusion(stable_diffusion_url, steps)
-        self.dp = DataProcessor(database_path)
-        self.steps = steps
+    def __init__(self, database_path: str, stable_diffusion_urls: list, steps: int, sd_timeout: float, sd_concurrency: int, queue_size: int, health_check_interval: float, max_images: int, result_cache_entries: int, result_cache_bytes: int, image_store_bytes: int, delivery_format: str, delivery_quality: int, encode_workers: int, download_timeout: float, max_download_bytes: int, source_cache_entries: int, source_cache_disk_entries: int, gen_log_buffer_size: int, gen_log_flush_interval: float, db_readers: int, use_workers: bool = False, job_max_age: float = 3600, job_max_attempts: int = 3, rate_limits: dict = None, rate_limit_save_interval: float = 60, vip_users: list = None, draft_steps: int = 10, priority_aging: float = 30):
+        self.sd_pool = BackendPool(
+            stable_diffusion_urls,
+            timeout=sd_timeout,
+            concurrency=sd_concurrency,
+            health_interval=health_check_interval
+        )
+        self.priorities = PriorityPolicy(vip_users, draft_steps=draft_steps, aging=priority_aging)
+        self.scheduler = JobScheduler(self.sd_pool, max_queue_size=queue_size, priorities=self.priorities)
+        self.queue_size = queue_size
+        self.use_workers = use_workers
+        self.job_max_age = job_max_age
+        self.job_max_attempts = max(1, int(job_max_attempts))
+        self.name = f'{socket.gethostname()}-{os.getpid()}'
+        self.resumed = []
+        self.rate_limiter = RateLimiter(rate_limits or {})
+        self.rate_limit_save_interval = rate_limit_save_interval
+        self.rate_limit_task = None
+        self.singleflight = SingleFlight()
+        self.result_cache = ResultCache(max_entries=result_cache_entries, max_bytes=result_cache_bytes)
+        self.dp = AsyncDataProcessor(database_path, readers=db_readers, buffer_size=gen_log_buffer_size)
+        self.image_store = ImageStore(max_bytes=image_store_bytes, index=self.dp)
+        self.encoder = DeliveryEncoder(delivery_format, quality=delivery_quality, workers=encode_workers)
+        self.preprocessor = ImagePreprocessor(workers=encode_workers, download_timeout=download_timeout, max_download_bytes=max_download_bytes)
+        self.source_cache = SourceCache(max_entries=source_cache_entries, max_disk_entries=source_cache_disk_entries)
+        self.delivery = ImageDelivery(self.dp, self.image_store, self.encoder, self.result_cache)
+        self.gen_log_flush_interval = gen_log_flush_interval
+        self.flush_task = None
+        self.sweep_task = None
+        self.steps = int(steps) if steps else 20
+        self.max_images = max(1, min(int(max_images), 10)) # Telegram media groups hold at most 10 photos
         
         self.logger = logging.getLogger(__name__)
 
@@ -58,9 +102,9 @@ class RequestHandler:
         '''
         Remove command and botname from user input.
         '''
-        commands = ["/start", "/help", "/logs", "/picgen", "/teach", "/forget", "/mywords", "/variation", "/safemode"]
+        commands = ["/start", "/help", "/logs", "/picgen", "/teach", "/forget", "/mywords", "/variation", "/safemode", "/again"]
         bot_username = self.__get_bot_username(update)
-        text = update.message.text
+        text = update.message.text or update.message.caption or ''
 
         for command in commands:
             text = text.replace(command, '')
@@ -70,150 +114,410 @@ class RequestHandler:
 
         return(text)
 
-    async def __get_image_from_reply(self, message: Message) -> str:
+    def __split_count(self, text: str):
+        '''
+        Split an optional leading image count ("/picgen 4 a cat") from the prompt.
+        Only numbers from 1 to max_images count, so prompts like "1984 dystopian city" are kept whole.
+        Returns the count and the rest of the prompt.
+        '''
+        first, _, rest = text.partition(' ')
+        if first.isdigit() and 1 <= int(first) <= self.max_images and rest.strip():
+            return int(first), rest.strip()
+        return 1, text
+
+    def __split_seed(self, text: str):
+        '''
+        Split an optional pinned seed ("seed:1234") from the prompt.
+        Returns the seed (-1 for random) and the rest of the prompt.
+        '''
+        match = re.search(r'(?:^|\s)seed[:=](\d+)(?=\s|$)', text)
+        if not match:
+            return -1, text
+        return int(match.group(1)), (text[:match.start()] + text[match.end():]).strip()
+
+    def __split_steps(self, text: str):
+        '''
+        Split an optional step count ("steps:8") from the prompt, for cheaper draft renders.
+        Returns the steps, capped at the configured steps, and the rest of the prompt.
+        '''
+        match = re.search(r'(?:^|\s)steps[:=](\d+)(?=\s|$)', text)
+        if not match:
+            return self.steps, text
+        return max(1, min(int(match.group(1)), self.steps)), (text[:match.start()] + text[match.end():]).strip()
+
+    def __get_image_from_reply(self, message: Message):
         '''
-        Get image from reply.
+        Get the photo size to download from a reply.
         '''
-        photo = message.photo[-1]
-        image = await photo.get_file()
-        return image
+        return self.preprocessor.select(message.photo)
     
-    async def __get_image_from_message(self, update: Update) -> str:
+    def __get_image_from_message(self, update: Update):
         '''
-        Get image from message.
+        Get the photo size to download from a message.
         '''
-        message = update.effective_message
-        photo = message.photo[-1]
-        image = await photo.get_file()
-        return image
+        return self.preprocessor.select(update.effective_message.photo)
 
     ####################
     # IMAGE GENERATION #
     ####################
 
-    def __read_image_file_into_memory(self, image_path: str):
+    async def __submit(self, user: dict, chat_id: int, chat_type: str, request: GenerationRequest, job_id: int, priority: int):
         '''
-        Read image file into memory.
+        Join the in-flight render of an identical request, or queue a new one for the userchat.
+        Returns (position, result, leader); leader is False for joined renders.
+        Raises QueueFullError if the queue is at capacity.
         '''
+        # Nothing may be awaited between looking up and registering the in-flight call
+        userchat_id = await self.dp.get_userchat_id(user, chat_id, chat_type)
+        key = request.key()
+        result = self.singleflight.get(key)
+        if result is not None:
+            return 0, result, False
+
+        position, result = self.scheduler.submit(
+            userchat_id, lambda sd, effective: self.__render(sd, request, job_id, effective), request.image_count, priority
+        )
+        self.singleflight.register(key, result)
+        return position, result, True
+
+    async def __collect(self, request: GenerationRequest, result, leader: bool) -> list:
+        '''
+        Wait for a submitted render; the leader caches the result of a pinned seed.
+        '''
+        images = await self.singleflight.wait(result)
+        if request.cacheable and leader:
+            await self.result_cache.put(request.key(), images)
+
+        # Every requester logs and archives its own copy of a shared result
+        return [replace(image, filename=f"{uuid.uuid4().hex}.png") for image in images]
+
+    async def __run_queued(self, update: Update, request: GenerationRequest, job_id: int, priority: int):
+        '''
+        Queue a generation request for the userchat and wait for its images.
+        Identical requests already in flight are joined instead of queued again.
+        Returns None (after replying to the user) if the job could not be run.
+        '''
+        # Only pinned seeds are reproducible, so only those are cached
+        if request.cacheable:
+            images = await self.result_cache.get(request.key())
+            if images:
+                return images
+
+        user = self.__get_username_from_update(update)
+        try:
+            position, result, leader = await self.__submit(
+                user, update.effective_chat.id, update.effective_chat.type, request, job_id, priority
+            )
+        except QueueFullError as e:
+            self.logger.warning(f'Rejected generation request: {e}')
+            self.__refund(update, request.image_count)
+            await update.message.reply_text(f'Too many images are being generated right now, please try again later.')
+            return None
+
+        if position > 0:
+            await update.message.reply_text(f'You are #{position} in queue.')
+
         try:
-            with open(image_path, "rb") as file:
-                image = file.read()
-                byte_stream = BytesIO(image)
-                byte_array = byte_stream.getvalue()
-                return byte_array
+            return await self.__collect(request, result, leader)
         except Exception as e:
-            self.logger.error(f'Error reading image file into memory: {e}')
+            self.logger.error(f'Error generating image: {e!r}')
+            await update.message.reply_text(f'Image generation failed, please try again later.')
             return None
-        
-    def __download_image_into_memory(self, *args, url=None):
-        """
-        Download an image from a url and read it into memory
-        """
-        if not url and args:
-            url = args[0]
-        headers = {
-            "User-Agent": "Chrome/51.0.2704.103",
-        }
-        response = requests.get(url,headers=headers)
-
-        if response.status_code == 200:
-            byte_stream = BytesIO(response.content)
-            byte_array = byte_stream.getvalue()
-            return byte_array
-        else:
-            return 1
-        
+
+    async def __deliver_images(self, update: Update, request: GenerationRequest, images: list, prompt: str, image_type: str, job_id: int = None):
+        '''
+        Archive and log generated images, then send them as a reply to the request.
+        '''
+        user = self.__get_username_from_update(update)
+        await self.delivery.deliver(
+            update.get_bot(), update.effective_chat.id, update.message.message_id, user, update.effective_chat.type,
+            request, images, prompt, image_type, job_id
+        )
+
+    def __job(self, update: Update, request: GenerationRequest, prompt: str, image_type: str) -> GenerationJob:
+        '''
+        The jobs table record of a generation request, with its priority class.
+        '''
+        user = self.__get_username_from_update(update)
+        return GenerationJob(
+            user=user,
+            chat_id=update.effective_chat.id,
+            chat_type=update.effective_chat.type,
+            message_id=update.message.message_id,
+            image_type=image_type,
+            prompt=prompt,
+            request=request,
+            priority=self.priorities.classify(user, update.effective_chat.type, request.steps),
+        )
+
+    async def __enqueue_job(self, update: Update, job: GenerationJob):
+        '''
+        Hand a generation request to the workers through the jobs table.
+        '''
+        queued = await self.dp.enqueue_job(job, self.queue_size)
+        if queued is None:
+            self.logger.warning(f'Rejected generation request: queue is full')
+            self.__refund(update, job.request.image_count)
+            await update.message.reply_text(f'Too many images are being generated right now, please try again later.')
+            return
+
+        job_id, ahead = queued
+        self.logger.debug(f'Queued job {job_id}, {ahead} jobs ahead')
+        if ahead > 0:
+            await update.message.reply_text(f'You are #{ahead + 1} in queue.')
+
+    async def __render(self, sd, request: GenerationRequest, job_id: int, priority: int):
+        '''
+        Render a request on a leased backend, marking its job as running with the priority it started with.
+        '''
+        await self.dp.set_job_state(job_id, RUNNING, effective_priority=priority)
+        return await sd.generate(request)
+
+    async def __generate(self, update: Update, request: GenerationRequest, prompt: str, image_type: str):
+        '''
+        Render a request and deliver the images, or queue it for the workers in bot mode.
+        The request is recorded as a job either way, so it survives a restart.
+        '''
+        job = self.__job(update, request, prompt, image_type)
+        if self.use_workers:
+            await self.__enqueue_job(update, job)
+            return
+
+        # Owned by this process, so workers never claim it
+        await self.dp.enqueue_job(job, worker=self.name)
+        try:
+            images = await self.__run_queued(update, request, job.job_id, job.priority)
+        except Exception as e:
+            await self.dp.set_job_state(job.job_id, FAILED, repr(e))
+            raise
+        if not images:
+            await self.dp.set_job_state(job.job_id, FAILED, 'Not rendered')
+            return
+
+        try:
+            await self.__deliver_images(update, request, images, prompt, image_type, job.job_id)
+        except Exception as e:
+            await self.dp.set_job_state(job.job_id, FAILED, repr(e))
+            raise
+        await self.dp.set_job_state(job.job_id, DONE)
+
+    async def __redispatch(self, bot, job: GenerationJob):
+        '''
+        Render and deliver a job left unfinished by a previous run.
+        Like new requests, it is served from the result cache or joins an identical resumed job.
+        '''
+        images = await self.result_cache.get(job.request.key()) if job.request.cacheable else None
+        if not images:
+            try:
+                _, result, leader = await self.__submit(job.user, job.chat_id, job.chat_type, job.request, job.job_id, job.priority)
+            except QueueFullError as e:
+                self.logger.warning(f'Dropped unfinished job {job.job_id}: {e}')
+                await self.dp.set_job_state(job.job_id, FAILED, repr(e))
+                return
+
+        try:
+            if not images:
+                images = await self.__collect(job.request, result, leader)
+            await self.delivery.deliver(
+                bot, job.chat_id, job.message_id, job.user, job.chat_type,
+                job.request, images, job.prompt, job.image_type, job.job_id
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.logger.error(f'Error running unfinished job {job.job_id}: {e!r}')
+            await self.dp.set_job_state(job.job_id, FAILED, repr(e))
+            return
+        await self.dp.set_job_state(job.job_id, DONE)
+
+    async def __notify_failure(self, bot, job: GenerationJob):
+        try:
+            await bot.send_message(
+                job.chat_id,
+                'Image generation failed, please try again later.',
+                reply_parameters=ReplyParameters(message_id=job.message_id, allow_sending_without_reply=True) if job.message_id else None
+            )
+        except TelegramError as e:
+            self.logger.error(f'Error notifying chat {job.chat_id} of failed job {job.job_id}: {e!r}')
+
+    async def __resume_jobs(self, bot):
+        '''
+        Dispatch the jobs a previous run accepted but never finished.
+        Jobs past the max age are dropped, and jobs whose images were already sent are closed.
+        Jobs that were started max attempts times already (and may be what brought the process
+        down) are failed.
+        '''
+        if self.job_max_age:
+            expired = await self.dp.expire_jobs(self.job_max_age)
+            if expired:
+                self.logger.warning(f'Dropped {expired} jobs older than {self.job_max_age} seconds')
+
+        for job in await self.dp.unfinished_jobs():
+            if await self.dp.job_delivered(job.job_id):
+                await self.dp.set_job_state(job.job_id, DONE)
+                continue
+            if job.attempts >= self.job_max_attempts:
+                self.logger.error(f'Giving up on unfinished job {job.job_id} after {job.attempts} attempts')
+                await self.dp.set_job_state(job.job_id, FAILED, 'Too many attempts')
+                await self.__notify_failure(bot, job)
+                continue
+            self.logger.info(f'Resuming job {job.job_id} (attempt {job.attempts + 1})')
+            self.resumed.append(asyncio.create_task(self.__redispatch(bot, job)))
+
+    async def __resend_last_image(self, update: Update, context: CallbackContext):
+        '''
+        Send the user's last image in this chat again.
+        '''
+        user = self.__get_username_from_update(update)
+        chat_id = update.effective_chat.id
+
+        last_image = await self.dp.get_last_image(user, chat_id)
+        if not last_image:
+            await update.message.reply_text(f'You have not generated any images here yet.')
+            return
+
+        filename, file_id, storage = last_image
+        spoiler = await self.dp.get_spoiler_status(user, chat_id)
+        if file_id:
+            await update.message.reply_photo(file_id, has_spoiler=spoiler)
+            return
+
+        # Images sent before file_ids were recorded are uploaded once from the archive
+        if not storage:
+            await update.message.reply_text(f'Your last image is no longer available.')
+            return
+        try:
+            data = await asyncio.to_thread(self.image_store.read, storage)
+        except OSError as e:
+            self.logger.error(f'Error reading archived image {storage}: {e}')
+            await update.message.reply_text(f'Your last image is no longer available.')
+            return
+
+        message = await update.message.reply_photo(await self.encoder.encode(data), has_spoiler=spoiler)
+        await self.dp.set_file_id(filename, message.photo[-1].file_id)
+
     async def __generate_new_image(self, update: Update, context: CallbackContext):
         '''
-        Generate an image based on user input.
+        Generate images based on user input.
         '''
         user = self.__get_username_from_update(update)
         chat_id = update.effective_chat.id
-        user_input = self.__clean_input(update)
+        count, user_input = self.__split_count(self.__clean_input(update))
+        seed, user_input = self.__split_seed(user_input)
+        steps, user_input = self.__split_steps(user_input)
 
         if not user_input:
             await update.message.reply_text(f'Please provide a prompt to generate an image.')
             return
+
+        if not await self.__admit(update, user, count):
+            return
         
-        aliases = self.__find_aliases(user_input)
-
-        for alias in aliases:
-            alias_text = self.dp.get_alias(user, chat_id, alias)
-            if alias_text:
-                user_input = user_input.replace(f'%{alias}', alias_text)
-
-        image_name = self.sd.generate_image(user_input)
-        image_path = f"/app/data/images/{image_name}"
-        self.logger.debug(f"user: {user}, chat_id: {update.effective_chat.id}, image_name: {image_name}, prompt: {user_input}, image_type: 'new', chat_type: {update.effective_chat.type}")
-        self.dp.log_new_image(user=user, chat_id=update.effective_chat.id, image_name=image_name, prompt=user_input, image_type='new', chat_type=update.effective_chat.type)
-        image = self.__read_image_file_into_memory(image_path)
-        await update.message.reply_photo(
-            image,
-            has_spoiler=self.dp.get_spoiler_status(user, update.effective_chat.id)
-            )
+        try:
+            user_input = await self.dp.expand_aliases(user, chat_id, user_input)
+        except AliasExpansionError as e:
+            self.__refund(update, count)
+            await update.message.reply_text(f'{e}. Please shorten your prompt or aliases.')
+            return
+
+        request = GenerationRequest.new_image(user_input, steps, count, seed)
+        await self.__generate(update, request, user_input, 'new')
     
     async def __generate_variation_image(self, update: Update, context: CallbackContext, request_type: str):
         '''
-        Generate a variation image based on user input.
+        Generate variation images based on user input.
         '''
         user = self.__get_username_from_update(update)
         chat_id = update.effective_chat.id
-        user_input = self.__clean_input(update)
+        count, user_input = self.__split_count(self.__clean_input(update))
+        seed, user_input = self.__split_seed(user_input)
+        steps, user_input = self.__split_steps(user_input)
 
         if not user_input:
             await update.message.reply_text(f'Please provide (or replay to) an image with a prompt to generate a variation of it.')
             return
-        
-        aliases = self.__find_aliases(user_input)
 
-        for alias in aliases:
-            alias_text = self.dp.get_alias(user, chat_id, alias)
-            if alias_text:
-                user_input = user_input.replace(f'%{alias}', alias_text)
+        try:
+            if request_type == 'photo':
+                photo = self.__get_image_from_message(update)
+            elif request_type == 'reply':
+                photo = self.__get_image_from_reply(update.message.reply_to_message)
+        except SourceImageError as e:
+            await update.message.reply_text(f'{e}, please send or reply to a photo.')
+            return
 
-        if request_type == 'photo':
-            image = await self.__get_image_from_message(update)
-            prompt = update.message.caption
-        elif request_type == 'reply':
-            image = await self.__get_image_from_reply(update.message.reply_to_message)
-            prompt = user_input
+        if not await self.__admit(update, user, count):
+            return
         
-        image_jpg = self.__download_image_into_memory(image.file_path)
-
-        image_name = self.sd.generate_image_variation(image_jpg, prompt=prompt)
-        image_path = f"/app/data/images/{image_name}"
-        self.logger.debug(f"user: {user}, chat_id: {update.effective_chat.id}, image_name: {image_name}, prompt: {prompt}, image_type: 'variation', chat_type: {update.effective_chat.type}")
-        self.dp.log_new_image(user=user, chat_id=update.effective_chat.id, image_name=image_name, prompt=prompt, image_type='variation', chat_type=update.effective_chat.type)
-        image = self.__read_image_file_into_memory(image_path)
-        await update.message.reply_photo(
-            image,
-            has_spoiler=self.dp.get_spoiler_status(user, update.effective_chat.id)
-        )
+        try:
+            user_input = await self.dp.expand_aliases(user, chat_id, user_input)
+        except AliasExpansionError as e:
+            self.__refund(update, count)
+            await update.message.reply_text(f'{e}. Please shorten your prompt or aliases.')
+            return
+        prompt = user_input
+
+        # Repeated variations of the same photo reuse the prepared source
+        source = await self.source_cache.get(photo.file_unique_id)
+        if source is None:
+            try:
+                source = await self.preprocessor.prepare(await self.preprocessor.download(photo))
+            except SourceImageError as e:
+                self.__refund(update, count)
+                await update.message.reply_text(f'{e}, please try another one.')
+                return
+            await self.source_cache.put(photo.file_unique_id, source)
+
+        request = GenerationRequest.variation(source, prompt, steps, count, seed)
+        await self.__generate(update, request, prompt, 'variation')
+
+    async def __admit(self, update: Update, user: dict, count: int) -> bool:
+        '''
+        Check the rate limits before any work is done for a request; every image costs one token.
+        Replies to the user and returns False if the request has to wait.
+        '''
+        wait = self.rate_limiter.admit(user.get('username') or user.get('full_name'), update.effective_chat.id, count)
+        if wait <= 0:
+            return True
+        self.logger.info(f'Rate limited {user} in chat {update.effective_chat.id} for {wait:.1f}s')
+        await update.message.reply_text(f'You are sending requests too fast, please try again in {math.ceil(wait)} seconds.')
+        return False
+
+    def __refund(self, update: Update, count: int):
+        '''
+        Return the tokens taken by __admit for a request rejected after admission.
+        '''
+        user = self.__get_username_from_update(update)
+        self.rate_limiter.refund(user.get('username') or user.get('full_name'), update.effective_chat.id, count)
+
+    async def __save_rate_limits(self):
+        '''
+        Periodically persist the rate limiter so a restart doesn't refill every bucket.
+        '''
+        while True:
+            await asyncio.sleep(self.rate_limit_save_interval)
+            await self.dp.save_rate_limits(self.rate_limiter.snapshot())
+
+    async def __sweep_image_store(self):
+        '''
+        Periodically keep the image store within budget while workers write to it.
+        '''
+        while True:
+            await self.image_store.sweep()
+            await asyncio.sleep(SWEEP_INTERVAL)
+
+    async def __flush_gen_log(self):
+        '''
+        Periodically write buffered gen_log rows.
+        '''
+        while True:
+            await asyncio.sleep(self.gen_log_flush_interval)
+            await self.dp.flush()
 
     ####################
     # ALIAS MANAGEMENT #
     ####################
 
-    def __find_aliases(self, text: str):
-        """
-        Find words marked as aliases in the text
-        """
-        marker_string = "%"
-
-        # Split the text into words
-        words = text.split(' ')
-        # Find the aliases
-        aliases = []
-        for word in words:
-            try:
-                # Strip any trailing special characters
-                word = word.strip('.,!?')
-                if word[0] == marker_string:
-                    aliases.append(word[1:])
-            except:
-                pass
-        return aliases
-
     async def __get_all_aliases(self, update: Update, context: CallbackContext):
         """
         Get all aliases for a user
@@ -222,7 +526,7 @@ class RequestHandler:
         user = self.__get_username_from_update(update)
         chat_id = update.effective_chat.id
         # Get list with all aliases and their values for the user
-        aliases = self.dp.dump_aliases(user, chat_id)
+        aliases = await self.dp.dump_aliases(user, chat_id)
 
         if aliases:
             alias_list = ''
@@ -255,7 +559,7 @@ class RequestHandler:
 
         try:
             self.logger.debug(f'Teaching alias {alias} for user {username}')
-            self.dp.teach_alias(username, chat_id, alias, text)
+            await self.dp.teach_alias(username, chat_id, alias, text)
             await update.message.reply_text(f'Taught alias {alias}.')
         # except ValueError as e: # ValueError is raised when the user does not have a valid username
         #     self.logger.error(f'Error teaching alias: {e}')
@@ -280,7 +584,7 @@ class RequestHandler:
 
         try:
             self.logger.debug(f'Forgetting alias {alias} for user {username}')
-            self.dp.forget_alias(username, chat_id, alias)
+            await self.dp.forget_alias(username, chat_id, alias)
             await update.message.reply_text(f'Forgot alias {alias}.')
         # except ValueError as e: # ValueError is raised when the user does not have a valid username
         #     self.logger.error(f'Error forgetting alias: {e}')
@@ -307,7 +611,7 @@ class RequestHandler:
             return
         
         spoiler_status = True if status == 'on' else False
-        self.dp.set_spoiler_status(user, chat_id, spoiler_status)
+        await self.dp.set_spoiler_status(user, chat_id, spoiler_status)
         await update.message.reply_text(f'Safemode is now {status}.')
 
     #####################
@@ -353,6 +657,12 @@ class RequestHandler:
         elif request_type == 'reply':
             await self.__generate_variation_image(update, context, 'reply')
 
+    async def __again_command_handler(self, update: Update, context: CallbackContext):
+        '''
+        Handler for the /again command.
+        '''
+        await self.__resend_last_image(update, context)
+
     async def __set_safemode_command_handler(self, update: Update, context: CallbackContext):
         '''
         Handler for the /safemode command.
@@ -369,6 +679,45 @@ class RequestHandler:
     # COMMAND HANDLERS #
     ####################
 
+    async def startup(self, application):
+        '''
+        Start background work once the application is initialized.
+        '''
+        if self.dp.buffer_size:
+            self.flush_task = asyncio.create_task(self.__flush_gen_log())
+        if self.rate_limiter.enabled:
+            self.rate_limiter.restore(await self.dp.load_rate_limits())
+            self.rate_limit_task = asyncio.create_task(self.__save_rate_limits())
+        # Workers write to the image store without a budget and pick up the jobs table themselves in bot mode
+        if self.use_workers and self.image_store.max_bytes:
+            self.sweep_task = asyncio.create_task(self.__sweep_image_store())
+        if not self.use_workers:
+            await self.__resume_jobs(application.bot)
+
+    async def shutdown(self, application):
+        '''
+        Release network resources and flush pending writes when the application stops.
+        '''
+        for task in self.resumed:
+            task.cancel()
+        await asyncio.gather(*self.resumed, return_exceptions=True)
+        await self.scheduler.close()
+        await self.sd_pool.close()
+        await self.image_store.close()
+        self.encoder.close()
+        self.preprocessor.close()
+        if self.sweep_task:
+            self.sweep_task.cancel()
+            await asyncio.gather(self.sweep_task, return_exceptions=True)
+        if self.flush_task:
+            self.flush_task.cancel()
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+        if self.rate_limit_task:
+            self.rate_limit_task.cancel()
+            await asyncio.gather(self.rate_limit_task, return_exceptions=True)
+            await self.dp.save_rate_limits(self.rate_limiter.snapshot())
+        await self.dp.close()
+
     async def start_command_handler(self, update: Update, context: CallbackContext):
         await self.__start_command_handler(update, context)
 
@@ -394,6 +743,9 @@ class RequestHandler:
         if update.message.caption and update.message.caption.startswith('/variation'):
             await self.__generate_variation_command_handler(update, context, 'photo')
     
+    async def again_command_handler(self, update: Update, context: CallbackContext):
+        await self.__again_command_handler(update, context)
+
     async def safemode_command_handler(self, update: Update, context: CallbackContext):
         await self.__set_safemode_command_handler(update, context)
     
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+import httpx
+
+from .stable_diffusion import StableDiffusion
+
+
+class BackendUnavailableError(Exception):
+    '''
+    Raised when no backend becomes available within the acquire timeout.
+    '''
+
+
+class Backend:
+    '''
+    A single Stable Diffusion server and its load.
+    '''
+    def __init__(self, sd: StableDiffusion, max_in_flight: int):
+        self.sd = sd
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.work = 0
+        self.healthy = True
+        self.failures = 0
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and self.in_flight < self.max_in_flight
+
+
+class BackendPool:
+    '''
+    Routes jobs across several Stable Diffusion servers by least outstanding work.
+    Backends are health-checked periodically; a backend is ejected after
+    `unhealthy_after` failed checks (or a connection error on a job) and
+    brought back on its first successful check. Waiting for a free backend
+    gives up after the request timeout, so jobs fail instead of hanging while
+    every backend is down.
+    '''
+    def __init__(self, urls: list, timeout: float, concurrency: int = 1,
+                 health_interval: float = 30.0, unhealthy_after: int = 2):
+        concurrency = max(1, int(concurrency))
+        self.backends = [
+            Backend(StableDiffusion(url, timeout=timeout, max_connections=concurrency + 1), concurrency)
+            for url in urls
+        ]
+        if not self.backends:
+            raise ValueError('At least one Stable Diffusion URL is required')
+
+        self.acquire_timeout = float(timeout)
+        self.health_interval = health_interval
+        self.unhealthy_after = max(1, int(unhealthy_after))
+        self.health_task = None
+        self.changed = None
+
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def capacity(self) -> int:
+        '''
+        Total number of jobs the pool can run at the same time.
+        '''
+        return sum(backend.max_in_flight for backend in self.backends)
+
+    ###########
+    # Helpers #
+    ###########
+
+    def __ensure_started(self):
+        '''
+        Create the loop-bound primitives and the health check task.
+        '''
+        if self.changed is None:
+            self.changed = asyncio.Condition()
+        if self.health_task is None:
+            self.health_task = asyncio.create_task(self.__health_loop())
+
+    async def __notify(self):
+        async with self.changed:
+            self.changed.notify_all()
+
+    def __pick(self):
+        '''
+        The available backend with the least outstanding work, or None.
+        '''
+        candidates = [backend for backend in self.backends if backend.available]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda backend: (backend.work, backend.in_flight))
+
+    def __mark(self, backend: Backend, healthy: bool):
+        '''
+        Record a health check result for a backend.
+        '''
+        if healthy:
+            if not backend.healthy:
+                self.logger.warning(f'Backend {backend.sd.url} recovered')
+            backend.failures = 0
+            backend.healthy = True
+            return
+
+        backend.failures += 1
+        if backend.healthy and backend.failures >= self.unhealthy_after:
+            self.logger.warning(f'Backend {backend.sd.url} is unhealthy, ejecting it')
+            backend.healthy = False
+
+    async def __health_loop(self):
+        '''
+        Periodically check every backend.
+        '''
+        while True:
+            results = await asyncio.gather(*(backend.sd.ping() for backend in self.backends))
+            for backend, healthy in zip(self.backends, results):
+                self.__mark(backend, healthy)
+            await self.__notify()
+            await asyncio.sleep(self.health_interval)
+
+    ##################
+    # Public methods #
+    ##################
+
+    async def acquire(self, cost: int = 1) -> Backend:
+        '''
+        Wait for a healthy backend with a free slot and reserve it.
+        Raises BackendUnavailableError if none is free within the acquire timeout.
+        '''
+        self.__ensure_started()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.acquire_timeout
+        async with self.changed:
+            backend = self.__pick()
+            while backend is None:
+                try:
+                    await asyncio.wait_for(self.changed.wait(), max(0.0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    raise BackendUnavailableError(f'No Stable Diffusion backend available after {self.acquire_timeout:.0f} seconds') from None
+                backend = self.__pick()
+            backend.in_flight += 1
+            backend.work += cost
+        return backend
+
+    async def release(self, backend: Backend, cost: int = 1, error: Exception = None):
+        '''
+        Free a slot reserved with acquire.
+        A connection error ejects the backend until the next successful health check;
+        read timeouts and other errors of a long render leave it in rotation.
+        '''
+        backend.in_flight -= 1
+        backend.work -= cost
+        if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)):
+            backend.failures = self.unhealthy_after - 1
+            self.__mark(backend, False)
+        await self.__notify()
+
+    @asynccontextmanager
+    async def lease(self, cost: int = 1):
+        '''
+        Reserve a backend for the duration of a job and yield its client.
+        '''
+        backend = await self.acquire(cost)
+        error = None
+        try:
+            yield backend.sd
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            await self.release(backend, cost, error)
+
+    async def close(self):
+        '''
+        Stop health checks and close every backend's connection pool.
+        '''
+        if self.health_task:
+            self.health_task.cancel()
+            await asyncio.gather(self.health_task, return_exceptions=True)
+            self.health_task = None
+        for backend in self.backends:
+            await backend.sd.close()
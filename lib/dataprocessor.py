@@ -1,17 +1,80 @@
 import apsw
+import time
 import uuid
 import logging
+import threading
+from collections import OrderedDict
+
+from .aliases import AliasRegistry
+from .jobs import GenerationJob, QUEUED, RUNNING, DONE, FAILED
 
 # @TODO: Add logging
 # @TODO: Update handlers in async_handlers.py to pass chat <dict> instead of chat_id <int>; update
 #        the aliasing and spoiler handlers to use __user_chat_handler() to log new chats in case they don't exist
 # @TODO: Create method to validate user username; raise exception if username is invalid for alias
 
+STATEMENT_CACHE_SIZE = 128
+
+
+class IdentityCache:
+    """
+    Bounded LRU cache mapping (user, telegram chat) to the userchat_id and spoiler status.
+    Safe to share between DataProcessor instances on different threads.
+    """
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return dict(entry)
+            return None
+
+    def put(self, key: tuple, userchat_id: int, spoiler: bool):
+        with self.lock:
+            self.entries[key] = {'userchat_id': userchat_id, 'spoiler': spoiler}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def set_spoiler(self, key: tuple, spoiler: bool):
+        with self.lock:
+            if key in self.entries:
+                self.entries[key]['spoiler'] = spoiler
+
+
 class DataProcessor:
-    def __init__(self, database: str):
-        self.con = apsw.Connection(database)
+    def __init__(self, database: str, identities: IdentityCache = None, aliases: AliasRegistry = None, buffer_size: int = 0):
+        # Registration and logging reuse a handful of statements; keep them all prepared
+        self.con = apsw.Connection(database, statementcachesize=STATEMENT_CACHE_SIZE)
         self.cursor = self.con.cursor()
+        self.identities = identities if identities is not None else IdentityCache()
+        self.aliases = aliases if aliases is not None else AliasRegistry()
+        self.image_type_ids = {}
+        self.chat_type_ids = {}
+        self.buffer_size = max(0, int(buffer_size))
+        self.pending_images = []
+        self.buffer_lock = threading.Lock()
         self.logger = logging.getLogger(__name__)
+        self.__configure()
+
+    def __configure(self):
+        """
+        Tune the connection: WAL journaling lets readers run alongside the writer,
+        and NORMAL sync only fsyncs the WAL on checkpoints.
+        """
+        self.con.setbusytimeout(5000)
+        try:
+            self.cursor.execute('PRAGMA journal_mode = WAL')
+            self.cursor.execute('PRAGMA synchronous = NORMAL')
+            self.cursor.execute('PRAGMA cache_size = -16000')
+            self.cursor.execute('PRAGMA temp_store = MEMORY')
+        except Exception as e:
+            self.logger.error('Error configuring database: %s', e)
 
     ###########
     # Getters #
@@ -21,10 +84,14 @@ class DataProcessor:
         """
         Get the chat_type_id from the chat type name.
         """
+        if chat_type in self.chat_type_ids:
+            return self.chat_type_ids[chat_type]
         sql = 'SELECT chat_type_id FROM chat_types WHERE name = ?'
         try:
             self.cursor.execute(sql, (chat_type,))
             result = self.cursor.fetchone()
+            if result:
+                self.chat_type_ids[chat_type] = result[0]
             return result[0] if result else None
         except Exception as e:
             self.logger.error('Error getting chat type id: %s', e)
@@ -49,33 +116,24 @@ class DataProcessor:
             sql = 'SELECT user_id FROM users WHERE full_name = ?'
             try:
                 self.cursor.execute(sql, (user['full_name'],))
-                return self.cursor.fetchone()
+                result = self.cursor.fetchone()
+                return result[0] if result else None
             except Exception as e:
                 self.logger.error('Error getting user id: %s', e)
                 return None
         
-    def __get_userchat_id(self, user_id: int, chat_id: int):
-        """
-        Get the userchat_id from the user_id and chat_id.
-        """
-        sql = 'SELECT userchat_id FROM userchats WHERE user_id = ? AND chat_id = ?'
-        data = (user_id, chat_id)
-        try:
-            self.cursor.execute(sql, data)
-            result = self.cursor.fetchone()
-            return result[0] if result else None
-        except Exception as e:
-            self.logger.error('Error getting userchat id: %s', e)
-            return None
-
     def __get_image_type_id(self, image_type: str):
         """
         Get the image_type_id from the image type name.
         """
+        if image_type in self.image_type_ids:
+            return self.image_type_ids[image_type]
         sql = 'SELECT image_type_id FROM image_types WHERE name = ?'
         try:
             self.cursor.execute(sql, (image_type,))
             result = self.cursor.fetchone()
+            if result:
+                self.image_type_ids[image_type] = result[0]
             return result[0] if result else None
         except Exception as e:
             self.logger.error('Error getting image type id: %s', e)
@@ -94,17 +152,21 @@ class DataProcessor:
             self.logger.error('Error getting chat id: %s', e)
             return None
 
-    def __get_spoiler_status(self, userchat_id: int):
+    def __get_userchat(self, user: dict, chat_id: int):
         """
-        Get the spoiler status from the userchat_id.
+        Get the userchat_id and spoiler status of the user in the telegram chat, without registering anything.
         """
-        sql = 'SELECT status FROM spoiler_status WHERE userchat_id = ?'
+        column = 'username' if user.get('username') else 'full_name'
+        sql = ('SELECT userchats.userchat_id, COALESCE(spoiler_status.status, 0) FROM userchats '
+               'JOIN users ON users.user_id = userchats.user_id '
+               'JOIN chats ON chats.chat_id = userchats.chat_id '
+               'LEFT JOIN spoiler_status ON spoiler_status.userchat_id = userchats.userchat_id '
+               f'WHERE users.{column} = ? AND chats.telegram_chat_id = ? LIMIT 1')
         try:
-            self.cursor.execute(sql, (userchat_id,))
-            result = self.cursor.fetchone()
-            return result[0] if result else None
+            self.cursor.execute(sql, (user[column], chat_id))
+            return self.cursor.fetchone()
         except Exception as e:
-            self.logger.error('Error getting spoiler status: %s', e)
+            self.logger.error('Error getting userchat: %s', e)
             return None
 
     def __dump_aliases(self, userchat_id: int):
@@ -134,86 +196,173 @@ class DataProcessor:
             self.logger.error('Error getting alias: %s', e)
             return None
         
+    def __get_last_image(self, userchat_id: int):
+        """
+        Get the filename, Telegram file_id and storage path of the last image of the userchat.
+        """
+        sql = 'SELECT filename, file_id, storage FROM gen_log WHERE userchat_id = ? ORDER BY timestamp DESC, rowid DESC LIMIT 1'
+        try:
+            self.cursor.execute(sql, (userchat_id,))
+            return self.cursor.fetchone()
+        except Exception as e:
+            self.logger.error('Error getting last image: %s', e)
+            return None
+
     ###########
     # Loggers #
     ###########
 
-    def __log_new_image(self, userchat_id, image_name: str, prompt: str, action_type_id: int):
+    def __log_new_image(self, userchat_id, image_name: str, prompt: str, action_type_id: int, storage: str, job_id: int):
         """
         Log a new image into the database.
+        With a write-behind buffer the row is queued and written with the next flush.
+        """
+        row = [userchat_id, prompt, action_type_id, image_name, None, storage, job_id]
+        if self.buffer_size:
+            with self.buffer_lock:
+                self.pending_images.append(row)
+                full = len(self.pending_images) >= self.buffer_size
+            if full:
+                self.flush()
+            return
+        self.__write_images([row])
+
+    def __write_images(self, rows: list):
         """
+        Insert gen_log rows in one transaction.
+        """
+        sql = 'INSERT INTO gen_log (userchat_id, prompt, image_type_id, filename, file_id, storage, job_id) VALUES (?, ?, ?, ?, ?, ?, ?)'
         try:
-            sql = 'INSERT INTO gen_log (userchat_id, prompt, image_type_id, filename) VALUES (?, ?, ?, ?)'
-            self.cursor.execute(sql, (userchat_id, prompt, action_type_id, image_name))
+            with self.con:
+                self.cursor.executemany(sql, rows)
         except Exception as e:
-            self.logger.error('Error logging image: %s', e)    
+            self.logger.error('Error logging image: %s', e)
     
+    def __upsert(self, sql: str, data: tuple):
+        """
+        Run a statement with a RETURNING clause and return the first returned value.
+        The rows are drained so the statement is finished before the transaction ends.
+        """
+        rows = self.cursor.execute(sql, data).fetchall()
+        return rows[0][0] if rows else None
+
     def __log_new_user(self, user: dict):
         """
         Log a new user into the database.
+        Returns the user_id of the new or existing user.
         """
-        sql = 'INSERT or IGNORE INTO users (username, full_name, is_username) VALUES (?, ?, ?)'
-        if user.get('username'):
-            data = (user['username'], user['full_name'], True)
-        else:
-            data = (str(uuid.uuid4()), user['full_name'], False)
         try:
-            self.cursor.execute(sql, data)
+            if user.get('username'):
+                # The no-op update makes RETURNING yield the id of an existing row too
+                sql = ('INSERT INTO users (username, full_name, is_username) VALUES (?, ?, 1) '
+                       'ON CONFLICT (username) DO UPDATE SET username = excluded.username RETURNING user_id')
+                return self.__upsert(sql, (user['username'], user['full_name']))
+
+            # Users without a username have no unique key, so insert only if the name is unknown
+            sql = ('INSERT INTO users (username, full_name, is_username) SELECT ?, ?, 0 '
+                   'WHERE NOT EXISTS (SELECT 1 FROM users WHERE full_name = ?) RETURNING user_id')
+            user_id = self.__upsert(sql, (str(uuid.uuid4()), user['full_name'], user['full_name']))
+            return user_id if user_id is not None else self.__get_user_id(user)
         except Exception as e:
             self.logger.error('Error logging user: %s', e)
             self.logger.error(f"user: {user}")
+            return None
     
     def __log_new_chat(self, chat_id: int, chat_type_id: int):
         """
         Log a new chat into the database.
+        Returns the chat_id of the new or existing chat.
         """
-        sql = 'INSERT or IGNORE INTO chats (telegram_chat_id, chat_type_id) VALUES (?, ?)'
+        sql = ('INSERT INTO chats (telegram_chat_id, chat_type_id) VALUES (?, ?) '
+               'ON CONFLICT (telegram_chat_id) DO UPDATE SET chat_type_id = excluded.chat_type_id RETURNING chat_id')
         data = (chat_id, chat_type_id)
         try:
-            self.cursor.execute(sql, data)
+            return self.__upsert(sql, data)
         except Exception as e:
             self.logger.error('Error logging chat: %s', e)
             self.logger.error(f"chat_id: {chat_id}, chat_type_id: {chat_type_id}")
+            return None
 
     def __log_new_userchat(self, user_id: int, chat_id: int):
         """
-        Log a new userchat into the database.
+        Log a new userchat into the database and initialize its spoiler status.
+        Returns the userchat_id and spoiler status of the new or existing userchat.
         """
-        sql = 'INSERT or IGNORE INTO userchats (user_id, chat_id) VALUES (?, ?)'
+        sql = ('INSERT INTO userchats (user_id, chat_id) VALUES (?, ?) '
+               'ON CONFLICT (user_id, chat_id) DO UPDATE SET user_id = excluded.user_id RETURNING userchat_id')
         data = (user_id, chat_id)
         try:
-            self.cursor.execute(sql, data)
+            userchat_id = self.__upsert(sql, data)
         except Exception as e:
             self.logger.error('Error logging userchat: %s', e)
+            return None, None
         
         # Initialize the spoiler status for the userchat
-        sql = 'INSERT or IGNORE INTO spoiler_status (userchat_id, status) VALUES (?, ?)'
-        userchat_id = self.__get_userchat_id(user_id, chat_id)
-        data = (userchat_id, False)
+        sql = ('INSERT INTO spoiler_status (userchat_id, status) VALUES (?, 0) '
+               'ON CONFLICT (userchat_id) DO UPDATE SET userchat_id = excluded.userchat_id RETURNING status')
         try:
-            self.cursor.execute(sql, data)
+            return userchat_id, self.__upsert(sql, (userchat_id,))
         except Exception as e:
             self.logger.error('Error initializing spoiler status: %s', e)
+            return userchat_id, None
 
     def __user_chat_handler(self, user: dict, chat_id, chat_type: str):
         """
         Log a new user and chat into the database.
+        Every entity is resolved by a single upsert, all in one transaction.
         """
-        self.__log_new_user(user)
-        user_id = self.__get_user_id(user)
-        chat_type_id = self.__get_chat_type_id(chat_type)
-        self.__log_new_chat(chat_id, chat_type_id)
-        chat_id = self.__get_chat_id(chat_id)
-        self.__log_new_userchat(user_id, chat_id)
-        userchat_id = self.__get_userchat_id(user_id, chat_id)
+        with self.con:
+            user_id = self.__log_new_user(user)
+            chat_type_id = self.__get_chat_type_id(chat_type)
+            chat_id = self.__log_new_chat(chat_id, chat_type_id)
+            userchat_id, spoiler = self.__log_new_userchat(user_id, chat_id)
 
         retval = {
             'user_id': user_id,
             'chat_id': chat_id,
-            'userchat_id': userchat_id
+            'userchat_id': userchat_id,
+            'spoiler': spoiler
         }
         return retval
         
+    def __identity_key(self, user: dict, chat_id: int):
+        """
+        Key of the user and telegram chat in the identity cache.
+        """
+        return (user.get('username') or user.get('full_name'), chat_id)
+
+    def __resolve_userchat(self, user: dict, chat_id: int, chat_type: str = None, register: bool = True):
+        """
+        Resolve the userchat_id and spoiler status of the user in the chat.
+        Served from the identity cache; on a miss the user and chat are registered
+        (when the chat type is known) and the result is cached. Without register
+        a miss is only looked up, so reader connections never write.
+        """
+        key = self.__identity_key(user, chat_id)
+        identity = self.identities.get(key)
+        if identity is not None:
+            return identity
+
+        userchat_id, spoiler = None, None
+        if chat_type and register:
+            identity = self.__user_chat_handler(user, chat_id, chat_type)
+            userchat_id, spoiler = identity['userchat_id'], identity['spoiler']
+        else:
+            userchat = self.__get_userchat(user, chat_id)
+            if userchat is not None:
+                userchat_id, spoiler = userchat
+
+        if userchat_id is None and register:
+            user_id = self.__get_user_id(user)
+            chat_id = self.__get_chat_id(chat_id)
+            if user_id is not None and chat_id is not None:
+                with self.con:
+                    userchat_id, spoiler = self.__log_new_userchat(user_id, chat_id)
+
+        if userchat_id is not None:
+            self.identities.put(key, userchat_id, spoiler)
+        return {'userchat_id': userchat_id, 'spoiler': spoiler}
+
     ###########
     # Setters #
     ###########
@@ -222,8 +371,9 @@ class DataProcessor:
         """
         Set the spoiler status for the user.
         """
-        sql = 'UPDATE spoiler_status SET status = ? WHERE userchat_id = ?'
-        data = (spoiler_status, userchat_id)
+        sql = ('INSERT INTO spoiler_status (userchat_id, status) VALUES (?, ?) '
+               'ON CONFLICT (userchat_id) DO UPDATE SET status = excluded.status')
+        data = (userchat_id, spoiler_status)
         try:
             self.cursor.execute(sql, data)
         except Exception as e:
@@ -240,6 +390,17 @@ class DataProcessor:
         except Exception as e:
             self.logger.error('Error setting alias: %s', e)
     
+    def __set_file_id(self, image_name: str, file_id: str):
+        """
+        Set the Telegram file_id of a logged image.
+        """
+        sql = 'UPDATE gen_log SET file_id = ? WHERE filename = ?'
+        data = (file_id, image_name)
+        try:
+            self.cursor.execute(sql, data)
+        except Exception as e:
+            self.logger.error('Error setting file id: %s', e)
+
     def __delete_alias(self, userchat_id: int, alias: str):
         """
         Delete the alias for the userchat.
@@ -255,73 +416,309 @@ class DataProcessor:
     # Public methods #  
     ##################
 
-    def log_new_image(self, user: dict, chat_id: int, image_name: str, prompt: str, image_type: str, chat_type: str):
+    def log_new_image(self, user: dict, chat_id: int, image_name: str, prompt: str, image_type: str, chat_type: str, storage: str = None, job_id: int = None):
         """
         Log a new image into the database.
         """
-        self.__user_chat_handler(user, chat_id, chat_type)
-        user_id = self.__get_user_id(user)
-        chat_id = self.__get_chat_id(chat_id)
-        userchat_id = self.__get_userchat_id(user_id, chat_id)
-        image_type_id = self.__get_image_type_id(image_type)
-        self.__log_new_image(userchat_id, image_name, prompt, image_type_id)
+        with self.con:
+            userchat_id = self.__resolve_userchat(user, chat_id, chat_type)['userchat_id']
+            image_type_id = self.__get_image_type_id(image_type)
+            self.__log_new_image(userchat_id, image_name, prompt, image_type_id, storage, job_id)
         
-    
+    def get_userchat_id(self, user: dict, chat_id: int, chat_type: str):
+        """
+        Get the userchat_id for the user, registering the user and chat if needed.
+        """
+        return self.__resolve_userchat(user, chat_id, chat_type)['userchat_id']
+
     def set_spoiler_status(self, user: dict, chat_id: int, spoiler_status: bool):
         """
         Set the spoiler status for the user.
         """
-        user_id = self.__get_user_id(user)
-        chat_id = self.__get_chat_id(chat_id)
-        userchat_id = self.__get_userchat_id(user_id, chat_id)
-        self.__set_spoiler_status(userchat_id, spoiler_status)
+        identity = self.__resolve_userchat(user, chat_id)
+        self.__set_spoiler_status(identity['userchat_id'], spoiler_status)
+        self.identities.set_spoiler(self.__identity_key(user, chat_id), spoiler_status)
 
-    def get_spoiler_status(self, user: dict, chat_id: int):
+    def get_spoiler_status(self, user: dict, chat_id: int, cached: bool = True):
         """
         Get the spoiler status for the user.
+        Processes that don't see /safemode changes (workers) read it uncached.
         """
         self.logger.debug(f'user: {user}, chat_id: {chat_id}')
-        user_id = self.__get_user_id(user)
-        chat_id = self.__get_chat_id(chat_id)
-        userchat_id = self.__get_userchat_id(user_id, chat_id)
-        return self.__get_spoiler_status(userchat_id)
+        if not cached:
+            userchat = self.__get_userchat(user, chat_id)
+            return userchat[1] if userchat else None
+        return self.__resolve_userchat(user, chat_id, register=False)['spoiler']
     
     def teach_alias(self, user: dict, chat_id: int, alias: str, replacement: str):
         """
         Set the alias for the user.
         """
-        user_id = self.__get_user_id(user)
-        chat_id = self.__get_chat_id(chat_id)
-        self.__log_new_userchat(user_id, chat_id)
-        userchat_id = self.__get_userchat_id(user_id, chat_id)
+        userchat_id = self.__resolve_userchat(user, chat_id)['userchat_id']
         self.__set_alias(userchat_id, alias, replacement)
+        self.aliases.invalidate(userchat_id)
     
     def forget_alias(self, user: dict, chat_id: int, alias: str):
         """
         Delete the alias for the user.
         """
-        user_id = self.__get_user_id(user)
-        chat_id = self.__get_chat_id(chat_id)
-        self.__log_new_userchat(user_id, chat_id)
-        userchat_id = self.__get_userchat_id(user_id, chat_id)
+        userchat_id = self.__resolve_userchat(user, chat_id)['userchat_id']
         self.__delete_alias(userchat_id, alias)
+        self.aliases.invalidate(userchat_id)
     
     def dump_aliases(self, user: dict, chat_id: int):
         """
         Get all the aliases for the user.
         """
-        user_id = self.__get_user_id(user)
-        chat_id = self.__get_chat_id(chat_id)
-        self.__log_new_userchat(user_id, chat_id)
-        userchat_id = self.__get_userchat_id(user_id, chat_id)
+        userchat_id = self.__resolve_userchat(user, chat_id, register=False)['userchat_id']
         return self.__dump_aliases(userchat_id)
     
     def get_alias(self, user: dict, chat_id: int, alias: str):
         """
         Get the alias for the user.
         """
-        user_id = self.__get_user_id(user)
-        chat_id = self.__get_chat_id(chat_id)
-        self.__log_new_userchat(user_id, chat_id)
-        userchat_id = self.__get_userchat_id(user_id, chat_id)
-        return self.__get_alias(userchat_id, alias)
\ No newline at end of file
+        userchat_id = self.__resolve_userchat(user, chat_id, register=False)['userchat_id']
+        return self.__get_alias(userchat_id, alias)
+
+    def expand_aliases(self, user: dict, chat_id: int, text: str):
+        """
+        Expand every alias of the user in text in a single pass.
+        The userchat's aliases are loaded with one query and kept compiled until they change.
+        Raises AliasExpansionError if the expanded text is too long.
+        """
+        userchat_id = self.__resolve_userchat(user, chat_id, register=False)['userchat_id']
+        expander = self.aliases.get(userchat_id, lambda: self.__dump_aliases(userchat_id))
+        return expander.expand(text)
+
+    def set_file_id(self, image_name: str, file_id: str):
+        """
+        Record the Telegram file_id of a delivered image.
+        """
+        with self.buffer_lock:
+            for row in self.pending_images:
+                if row[3] == image_name:
+                    row[4] = file_id
+                    return
+        self.__set_file_id(image_name, file_id)
+
+    def get_last_image(self, user: dict, chat_id: int):
+        """
+        Get the filename, Telegram file_id and storage path of the user's last image in the chat.
+        """
+        userchat_id = self.__resolve_userchat(user, chat_id, register=False)['userchat_id']
+        with self.buffer_lock:
+            for row in reversed(self.pending_images):
+                if row[0] == userchat_id:
+                    return (row[3], row[4], row[5])
+        return self.__get_last_image(userchat_id)
+
+    def eviction_candidates(self, limit: int):
+        """
+        Storage paths that may be evicted from the image store, least recently used first.
+        The last image of every userchat is kept so /again can still upload it.
+        """
+        self.flush()
+        sql = '''
+            SELECT storage FROM gen_log
+            WHERE storage IS NOT NULL
+            GROUP BY storage
+            HAVING storage NOT IN (
+                SELECT last FROM (
+                    SELECT (SELECT storage FROM gen_log WHERE userchat_id = userchats.userchat_id
+                            ORDER BY timestamp DESC, rowid DESC LIMIT 1) AS last
+                    FROM userchats
+                ) WHERE last IS NOT NULL
+            )
+            ORDER BY MAX(timestamp)
+            LIMIT ?
+        '''
+        try:
+            self.cursor.execute(sql, (limit,))
+            return [row[0] for row in self.cursor.fetchall()]
+        except Exception as e:
+            self.logger.error('Error getting eviction candidates: %s', e)
+            return []
+
+    def mark_evicted(self, paths: list):
+        """
+        Record that stored files have been removed from the image store.
+        """
+        with self.buffer_lock:
+            for row in self.pending_images:
+                if row[5] in paths:
+                    row[5] = None
+        sql = 'UPDATE gen_log SET storage = NULL WHERE storage = ?'
+        try:
+            with self.con:
+                self.cursor.executemany(sql, [(path,) for path in paths])
+        except Exception as e:
+            self.logger.error('Error marking images evicted: %s', e)
+
+    def enqueue_job(self, job: GenerationJob, max_queued: int = None, worker: str = None):
+        """
+        Add a generation job to the jobs table.
+        Jobs queued with a worker belong to it and are never claimed by other workers.
+        Returns the job_id and the number of queued jobs ahead of it, or None if the queue is full.
+        """
+        with self.con:
+            userchat_id = self.__resolve_userchat(job.user, job.chat_id, job.chat_type)['userchat_id']
+            self.cursor.execute('SELECT COUNT(*) FROM jobs WHERE state = ?', (QUEUED,))
+            ahead = self.cursor.fetchone()[0]
+            if max_queued is not None and ahead >= max_queued:
+                return None
+
+            sql = ('INSERT INTO jobs (userchat_id, user, telegram_chat_id, chat_type, message_id, image_type, prompt, request, priority, worker) '
+                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) RETURNING job_id')
+            job.job_id = self.__upsert(sql, (userchat_id,) + job.to_row() + (worker,))
+        return job.job_id, ahead
+
+    def claim_job(self, worker: str, lease_seconds: float, aging: float = 0):
+        """
+        Claim the next queued job (or one whose worker's lease ran out) for worker.
+        The best priority goes first, lifted by one class for every aging seconds a job
+        has waited (0 disables aging); then userchats with the fewest running jobs, then
+        the oldest job. The effective priority the job was claimed with is recorded.
+        Returns the GenerationJob, or None if nothing is waiting.
+        """
+        now = time.time()
+        # Dividing by infinity turns aging off
+        aging = aging or float('inf')
+        # Jobs age in whole classes, so the running jobs tie-break still applies within a class
+        effective = "MAX(0, priority - CAST((julianday('now') - julianday(created)) * 86400.0 / ? AS INTEGER))"
+        sql = f'''
+            UPDATE jobs SET state = ?, worker = ?, lease_expires = ?, attempts = attempts + 1,
+                            effective_priority = {effective}
+            WHERE job_id = (
+                SELECT job_id FROM jobs AS waiting
+                WHERE (state = ? AND worker IS NULL) OR (state = ? AND lease_expires < ?)
+                ORDER BY {effective},
+                         (SELECT COUNT(*) FROM jobs WHERE state = ? AND userchat_id = waiting.userchat_id
+                          AND lease_expires >= ?), job_id
+                LIMIT 1
+            )
+            RETURNING job_id, attempts, user, telegram_chat_id, chat_type, message_id, image_type, prompt, request, priority
+        '''
+        data = (RUNNING, worker, now + lease_seconds, aging, QUEUED, RUNNING, now, aging, RUNNING, now)
+        try:
+            with self.con:
+                rows = self.cursor.execute(sql, data).fetchall()
+        except Exception as e:
+            self.logger.error('Error claiming job: %s', e)
+            return None
+        return GenerationJob.from_row(rows[0]) if rows else None
+
+    def renew_job_lease(self, job_id: int, worker: str, lease_seconds: float) -> bool:
+        """
+        Extend a worker's lease on a running job.
+        Returns False if the job is no longer held by the worker.
+        """
+        sql = 'UPDATE jobs SET lease_expires = ? WHERE job_id = ? AND worker = ? AND state = ? RETURNING job_id'
+        with self.con:
+            return self.__upsert(sql, (time.time() + lease_seconds, job_id, worker, RUNNING)) is not None
+
+    def set_job_state(self, job_id: int, state: str, error: str = None, effective_priority: int = None):
+        """
+        Move a job to another state.
+        Jobs moved back to queued are released for any worker to claim; done and failed jobs are finished.
+        Jobs started by the in-process scheduler count an attempt and record the effective priority they started with.
+        """
+        if state == QUEUED:
+            sql = 'UPDATE jobs SET state = ?, error = ?, worker = NULL, lease_expires = NULL WHERE job_id = ?'
+            data = (state, error, job_id)
+        elif state in (DONE, FAILED):
+            sql = 'UPDATE jobs SET state = ?, error = ?, finished = CURRENT_TIMESTAMP WHERE job_id = ?'
+            data = (state, error, job_id)
+        elif state == RUNNING:
+            sql = ('UPDATE jobs SET state = ?, error = ?, attempts = attempts + 1, '
+                   'effective_priority = COALESCE(?, effective_priority) WHERE job_id = ?')
+            data = (state, error, effective_priority, job_id)
+        else:
+            sql = 'UPDATE jobs SET state = ?, error = ? WHERE job_id = ?'
+            data = (state, error, job_id)
+        try:
+            with self.con:
+                self.cursor.execute(sql, data)
+        except Exception as e:
+            self.logger.error('Error setting job state: %s', e)
+
+    def expire_jobs(self, max_age: float) -> int:
+        """
+        Fail every unfinished job older than max_age seconds.
+        Returns the number of expired jobs.
+        """
+        sql = ("UPDATE jobs SET state = ?, error = 'Expired', finished = CURRENT_TIMESTAMP "
+               "WHERE state IN (?, ?) AND created < datetime('now', ?) RETURNING job_id")
+        try:
+            with self.con:
+                return len(self.cursor.execute(sql, (FAILED, QUEUED, RUNNING, f'-{int(max_age)} seconds')).fetchall())
+        except Exception as e:
+            self.logger.error('Error expiring jobs: %s', e)
+            return 0
+
+    def unfinished_jobs(self) -> list:
+        """
+        Every queued or running job, oldest first.
+        """
+        sql = ('SELECT job_id, attempts, user, telegram_chat_id, chat_type, message_id, image_type, prompt, request, priority '
+               'FROM jobs WHERE state IN (?, ?) ORDER BY job_id')
+        try:
+            self.cursor.execute(sql, (QUEUED, RUNNING))
+            return [GenerationJob.from_row(row) for row in self.cursor.fetchall()]
+        except Exception as e:
+            self.logger.error('Error getting unfinished jobs: %s', e)
+            return []
+
+    def job_delivered(self, job_id: int) -> bool:
+        """
+        Whether the images of a job already reached Telegram.
+        """
+        with self.buffer_lock:
+            for row in self.pending_images:
+                if row[6] == job_id and row[4]:
+                    return True
+        sql = 'SELECT 1 FROM gen_log WHERE job_id = ? AND file_id IS NOT NULL LIMIT 1'
+        try:
+            self.cursor.execute(sql, (job_id,))
+            return self.cursor.fetchone() is not None
+        except Exception as e:
+            self.logger.error('Error checking job delivery: %s', e)
+            return False
+
+    def save_rate_limits(self, rows: list):
+        """
+        Replace the saved rate limiter buckets with rows of (scope, key, tokens, updated).
+        """
+        try:
+            with self.con:
+                self.cursor.execute('DELETE FROM rate_limits')
+                self.cursor.executemany('INSERT INTO rate_limits (scope, key, tokens, updated) VALUES (?, ?, ?, ?)', rows)
+        except Exception as e:
+            self.logger.error('Error saving rate limits: %s', e)
+
+    def load_rate_limits(self) -> list:
+        """
+        The saved rate limiter buckets.
+        """
+        try:
+            self.cursor.execute('SELECT scope, key, tokens, updated FROM rate_limits')
+            return self.cursor.fetchall()
+        except Exception as e:
+            self.logger.error('Error loading rate limits: %s', e)
+            return []
+
+    def flush(self):
+        """
+        Write every buffered gen_log row.
+        """
+        with self.buffer_lock:
+            rows, self.pending_images = self.pending_images, []
+        if rows:
+            self.__write_images(rows)
+            self.logger.debug(f'Flushed {len(rows)} gen_log rows')
+
+    def close(self):
+        """
+        Flush buffered writes and close the connection.
+        """
+        self.flush()
+        self.con.close()
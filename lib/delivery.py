@@ -0,0 +1,136 @@
+import asyncio
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+from telegram import Bot, InputMediaPhoto, ReplyParameters
+
+from .stable_diffusion import GeneratedImage, GenerationRequest
+
+
+FORMATS = {
+    'png': 'PNG',
+    'jpeg': 'JPEG',
+    'jpg': 'JPEG',
+    'webp': 'WEBP',
+}
+
+
+class DeliveryEncoder:
+    '''
+    Re-encodes generated images for upload to Telegram.
+    Telegram recompresses photos anyway, so a lossy format at a high quality
+    uploads a fraction of the PNG bytes. Encoding runs on a small thread pool
+    (Pillow releases the GIL while encoding) to keep it off the event loop.
+    PNG delivers the server's bytes untouched.
+    '''
+    def __init__(self, format: str = 'jpeg', quality: int = 90, workers: int = 2):
+        format = (format or 'png').lower()
+        if format not in FORMATS:
+            raise ValueError(f'Unsupported delivery format {format}, use one of {", ".join(FORMATS)}')
+        self.format = FORMATS[format]
+        self.quality = max(1, min(int(quality), 100))
+        self.executor = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix='encoder')
+
+        self.logger = logging.getLogger(__name__)
+
+    ###########
+    # Helpers #
+    ###########
+
+    def __encode(self, data: bytes) -> bytes:
+        image = Image.open(io.BytesIO(data))
+        if self.format == 'JPEG' and image.mode != 'RGB':
+            image = image.convert('RGB')
+        output = io.BytesIO()
+        image.save(output, format=self.format, quality=self.quality)
+        self.logger.debug(f'Encoded {len(data)} byte PNG as {len(output.getbuffer())} byte {self.format}')
+        return output.getvalue()
+
+    ##################
+    # Public methods #
+    ##################
+
+    async def encode(self, data: bytes) -> bytes:
+        '''
+        The image in the delivery format.
+        '''
+        if self.format == 'PNG':
+            return data
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.__encode, data)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class ImageDelivery:
+    '''
+    Archives, logs and sends generated images to the chat that asked for them.
+    Works from a Bot and the chat and message ids alone, so the bot and the
+    generation workers deliver the same way. Workers set cached_spoiler to False:
+    /safemode changes only reach the identity cache of the bot process.
+    '''
+    def __init__(self, dp, image_store, encoder: DeliveryEncoder, result_cache, cached_spoiler: bool = True):
+        self.dp = dp
+        self.cached_spoiler = cached_spoiler
+        self.image_store = image_store
+        self.encoder = encoder
+        self.result_cache = result_cache
+
+        self.logger = logging.getLogger(__name__)
+
+    ###########
+    # Helpers #
+    ###########
+
+    async def __photo(self, image: GeneratedImage):
+        '''
+        What to send for an image: its file_id if Telegram has it, otherwise the encoded upload.
+        '''
+        if image.file_id:
+            return image.file_id
+        return await self.encoder.encode(image.data)
+
+    ##################
+    # Public methods #
+    ##################
+
+    async def send(self, bot: Bot, chat_id: int, reply_to: int, images: list, spoiler: bool) -> list:
+        '''
+        Send images as one reply, reusing Telegram file_ids where known.
+        Images Telegram doesn't have yet are uploaded in the delivery format.
+        Returns the file_id of every sent image.
+        '''
+        # The request may have been deleted by the time a queued job finishes
+        reply_parameters = ReplyParameters(message_id=reply_to, allow_sending_without_reply=True) if reply_to else None
+        photos = await asyncio.gather(*(self.__photo(image) for image in images))
+        if len(photos) == 1:
+            message = await bot.send_photo(chat_id, photos[0], has_spoiler=spoiler, reply_parameters=reply_parameters)
+            messages = [message]
+        else:
+            messages = await bot.send_media_group(
+                chat_id,
+                [InputMediaPhoto(photo, has_spoiler=spoiler) for photo in photos],
+                reply_parameters=reply_parameters
+            )
+        return [message.photo[-1].file_id if message.photo else None for message in messages]
+
+    async def deliver(self, bot: Bot, chat_id: int, reply_to: int, user: dict, chat_type: str,
+                      request: GenerationRequest, images: list, prompt: str, image_type: str, job_id: int = None):
+        '''
+        Archive and log generated images, then send them as one reply.
+        '''
+        for image in images:
+            storage = self.image_store.archive(image)
+            self.logger.debug(f"user: {user}, chat_id: {chat_id}, image_name: {image.filename}, storage: {storage}, prompt: {prompt}, image_type: '{image_type}', chat_type: {chat_type}")
+            await self.dp.log_new_image(user=user, chat_id=chat_id, image_name=image.filename, prompt=prompt, image_type=image_type, chat_type=chat_type, storage=storage, job_id=job_id)
+
+        spoiler = await self.dp.get_spoiler_status(user, chat_id, cached=self.cached_spoiler)
+        file_ids = await self.send(bot, chat_id, reply_to, images, spoiler)
+
+        for image, file_id in zip(images, file_ids):
+            if file_id:
+                await self.dp.set_file_id(image.filename, file_id)
+        if request.cacheable:
+            await self.result_cache.set_file_ids(request.key(), file_ids)
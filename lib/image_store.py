@@ -0,0 +1,187 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+
+from PIL import Image, PngImagePlugin
+
+from .stable_diffusion import GeneratedImage
+
+
+IMAGE_DIRECTORY = "/app/data/images"
+EVICTION_BATCH = 100
+SWEEP_INTERVAL = 300
+
+
+class ImageStore:
+    '''
+    Content-addressed archive of generated images.
+    Images are named by the hash of their data and parameters and sharded into
+    two levels of subdirectories (ab/cd/abcd...png), so identical images are
+    stored once. Files are written in the background, off the delivery path.
+    With a disk budget the least recently used files that are nobody's last
+    image are evicted once the store outgrows it; index records where each
+    file lives (see DataProcessor.eviction_candidates and mark_evicted).
+    Usage is only counted in-process, so when several processes write to the
+    same directory exactly one of them gets the budget and calls sweep; the
+    others run without one.
+    '''
+    def __init__(self, directory: str = IMAGE_DIRECTORY, max_bytes: int = 0, index=None):
+        self.directory = directory
+        self.max_bytes = max(0, int(max_bytes))
+        self.index = index
+        self.usage = None
+        self.queue = None
+        self.worker = None
+        self.queued = set()
+
+        self.logger = logging.getLogger(__name__)
+
+    ###########
+    # Helpers #
+    ###########
+
+    def __measure(self) -> int:
+        '''
+        Total size of every file in the store.
+        '''
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+    def __write(self, image: GeneratedImage, storage: str) -> int:
+        '''
+        Encode the image with its pnginfo and write it to the store.
+        Returns the number of bytes written; 0 if the file was already stored.
+        '''
+        path = os.path.join(self.directory, storage)
+        if os.path.exists(path):
+            return 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        pnginfo = PngImagePlugin.PngInfo()
+        pnginfo.add_text("parameters", image.parameters)
+        temp_path = f'{path}.tmp'
+        Image.open(io.BytesIO(image.data)).save(temp_path, format='PNG', pnginfo=pnginfo)
+        os.replace(temp_path, path)
+        return os.path.getsize(path)
+
+    def __remove(self, paths: list) -> int:
+        '''
+        Delete stored files. Returns the number of bytes freed.
+        '''
+        freed = 0
+        for storage in paths:
+            path = os.path.join(self.directory, storage)
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                freed += size
+            except FileNotFoundError:
+                pass
+        return freed
+
+    async def __evict(self):
+        '''
+        Remove the least recently used unreferenced files until the store is within budget.
+        '''
+        while self.usage > self.max_bytes:
+            paths = await self.index.eviction_candidates(EVICTION_BATCH)
+            if not paths:
+                self.logger.warning(f'Image store is over budget ({self.usage} bytes) but nothing can be evicted')
+                return
+
+            evicted = []
+            for storage in paths:
+                if self.usage <= self.max_bytes:
+                    break
+                self.usage -= await asyncio.to_thread(self.__remove, [storage])
+                evicted.append(storage)
+
+            await self.index.mark_evicted(evicted)
+            self.logger.info(f'Evicted {len(evicted)} images, store is at {self.usage} bytes')
+
+    async def __worker(self):
+        '''
+        Write queued images one at a time on a worker thread.
+        '''
+        if self.max_bytes:
+            self.usage = await asyncio.to_thread(self.__measure)
+            self.logger.info(f'Image store holds {self.usage} bytes')
+
+        while True:
+            image, storage = await self.queue.get()
+            try:
+                written = await asyncio.to_thread(self.__write, image, storage)
+                self.logger.debug(f'Archived {image.filename} as {storage}' if written else f'{storage} is already stored')
+                if self.max_bytes:
+                    self.usage += written
+                    if self.index is not None and self.usage > self.max_bytes:
+                        await self.__evict()
+            except Exception as e:
+                self.logger.error(f'Error archiving image {image.filename}: {e}')
+            finally:
+                self.queued.discard(storage)
+                self.queue.task_done()
+
+    ##################
+    # Public methods #
+    ##################
+
+    def path(self, image: GeneratedImage) -> str:
+        '''
+        The path of an image in the store, relative to its directory.
+        '''
+        digest = hashlib.sha256(image.data)
+        digest.update(image.parameters.encode('utf-8'))
+        name = digest.hexdigest()
+        return os.path.join(name[:2], name[2:4], f'{name}.png')
+
+    def read(self, storage: str) -> bytes:
+        '''
+        Read a stored image.
+        '''
+        with open(os.path.join(self.directory, storage), 'rb') as file:
+            return file.read()
+
+    def archive(self, image: GeneratedImage) -> str:
+        '''
+        Queue an image to be written to disk.
+        Returns the path it will be stored under.
+        '''
+        if self.worker is None:
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.create_task(self.__worker())
+
+        storage = self.path(image)
+        if storage not in self.queued:
+            self.queued.add(storage)
+            self.queue.put_nowait((image, storage))
+        return storage
+
+    async def sweep(self):
+        '''
+        Measure the store on disk and evict down to the budget.
+        '''
+        if not self.max_bytes or self.index is None:
+            return
+        self.usage = await asyncio.to_thread(self.__measure)
+        if self.usage > self.max_bytes:
+            await self.__evict()
+
+    async def close(self):
+        '''
+        Write every pending image, then stop the worker.
+        '''
+        if self.worker is None:
+            return
+        await self.queue.join()
+        self.worker.cancel()
+        await asyncio.gather(self.worker, return_exceptions=True)
+        self.worker = None
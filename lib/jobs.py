@@ -0,0 +1,64 @@
+import json
+from dataclasses import asdict, dataclass
+
+from .priority import GROUP
+from .stable_diffusion import GenerationRequest
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+@dataclass
+class GenerationJob:
+    '''
+    A generation request as stored in the jobs table.
+    Holds everything a worker needs to render the request and reply to it
+    without the original Telegram update.
+    '''
+    user: dict
+    chat_id: int
+    chat_type: str
+    message_id: int
+    image_type: str
+    prompt: str
+    request: GenerationRequest
+    job_id: int = None
+    attempts: int = 0
+    priority: int = GROUP
+
+    def to_row(self) -> tuple:
+        '''
+        The (user, telegram_chat_id, chat_type, message_id, image_type, prompt, request, priority) columns.
+        '''
+        return (
+            json.dumps(self.user),
+            self.chat_id,
+            self.chat_type,
+            self.message_id,
+            self.image_type,
+            self.prompt,
+            json.dumps(asdict(self.request)),
+            self.priority,
+        )
+
+    @classmethod
+    def from_row(cls, row: tuple):
+        '''
+        A job from its (job_id, attempts, user, telegram_chat_id, chat_type, message_id, image_type, prompt, request, priority) columns.
+        '''
+        job_id, attempts, user, chat_id, chat_type, message_id, image_type, prompt, request, priority = row
+        return cls(
+            user=json.loads(user),
+            chat_id=chat_id,
+            chat_type=chat_type,
+            message_id=message_id,
+            image_type=image_type,
+            prompt=prompt,
+            request=GenerationRequest(**json.loads(request)),
+            job_id=job_id,
+            attempts=attempts,
+            priority=priority,
+        )
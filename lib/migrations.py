@@ -0,0 +1,244 @@
+import apsw
+import logging
+
+
+'''
+Versioned schema migrations.
+The applied version is tracked in PRAGMA user_version; each migration runs in
+its own transaction together with the version bump. Add new migrations to the
+end of MIGRATIONS, never edit one that has shipped.
+'''
+
+
+BASELINE = '''
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username VARCHAR UNIQUE NOT NULL,
+    full_name VARCHAR NOT NULL,
+    is_username BOOLEAN NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS chat_types (
+    chat_type_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name VARCHAR NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_chat_id INTEGER UNIQUE NOT NULL,
+    chat_type_id INTEGER NOT NULL,
+    FOREIGN KEY (chat_type_id) REFERENCES chat_types(chat_type_id)
+);
+
+CREATE TABLE IF NOT EXISTS userchats (
+    userchat_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    chat_id VARCHAR NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES users(user_id)
+    UNIQUE (user_id, chat_id)
+);
+
+CREATE TABLE IF NOT EXISTS image_types(
+    image_type_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name VARCHAR NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS gen_log(
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+    userchat_id INTEGER NOT NULL,
+    prompt VARCHAR NOT NULL,
+    image_type_id INTEGER NOT NULL,
+    filename VARCHAR PRIMARY KEY UNIQUE,
+    FOREIGN KEY (userchat_id) REFERENCES userchats(userchat_id),
+    FOREIGN KEY (image_type_id) REFERENCES image_types(image_type_id)
+);
+
+CREATE TABLE IF NOT EXISTS aliases (
+    userchat_id INTEGER,
+    alias VARCHAR NOT NULL,
+    replacement VARCHAR NOT NULL,
+    PRIMARY KEY (userchat_id, alias),
+    FOREIGN KEY (userchat_id) REFERENCES userchats(userchat_id)
+);
+
+CREATE TABLE IF NOT EXISTS spoiler_status (
+    userchat_id INTEGER NOT NULL,
+    status BOOLEAN NOT NULL,
+    PRIMARY KEY (userchat_id),
+    FOREIGN KEY (userchat_id) REFERENCES userchats(userchat_id)
+);
+
+CREATE TABLE IF NOT EXISTS fixed_prompt_types (
+    prompt_type_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name VARCHAR NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS custom_fixed_prompts(
+    userchat_id INTEGER,
+    prompt_type_id INTEGER,
+    prompt VARCHAR NOT NULL,
+    PRIMARY KEY (userchat_id, prompt_type_id),
+    FOREIGN KEY (userchat_id) REFERENCES userchats(userchat_id),
+    FOREIGN KEY (prompt_type_id) REFERENCES fixed_prompt_types(prompt_type_id)
+);
+
+-- Databases created by the old entrypoint already hold the lookup rows
+INSERT INTO chat_types (name) SELECT column1 FROM (VALUES ('private'),('group'),('channel'),('supergroup'))
+    WHERE NOT EXISTS (SELECT 1 FROM chat_types);
+INSERT INTO fixed_prompt_types (name) SELECT column1 FROM (VALUES ('positive'),('negative'))
+    WHERE NOT EXISTS (SELECT 1 FROM fixed_prompt_types);
+INSERT INTO image_types (name) SELECT column1 FROM (VALUES ('new'),('variation'))
+    WHERE NOT EXISTS (SELECT 1 FROM image_types);
+'''
+
+
+def add_gen_log_file_id(con: apsw.Connection):
+    '''
+    Telegram file_id of each delivered image; older bots may have added it already.
+    '''
+    columns = [row[1] for row in con.execute('PRAGMA table_info(gen_log)')]
+    if 'file_id' not in columns:
+        con.execute('ALTER TABLE gen_log ADD COLUMN file_id VARCHAR')
+
+
+USERCHATS_INTEGER_CHAT_ID = '''
+-- userchats.chat_id joins to the INTEGER chats.chat_id; VARCHAR affinity stored it as text
+CREATE TABLE userchats_new (
+    userchat_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES users(user_id),
+    FOREIGN KEY (chat_id) REFERENCES chats(chat_id),
+    UNIQUE (user_id, chat_id)
+);
+INSERT OR IGNORE INTO userchats_new (userchat_id, user_id, chat_id)
+    SELECT userchat_id, user_id, CAST(chat_id AS INTEGER) FROM userchats;
+DROP TABLE userchats;
+ALTER TABLE userchats_new RENAME TO userchats;
+'''
+
+
+INDEXES = '''
+-- Last image of a userchat (/again) and per-userchat history
+CREATE INDEX IF NOT EXISTS gen_log_userchat_timestamp ON gen_log (userchat_id, timestamp);
+-- Users without a Telegram username are looked up by their full name
+CREATE INDEX IF NOT EXISTS users_full_name ON users (full_name);
+'''
+
+
+def add_gen_log_storage(con: apsw.Connection):
+    '''
+    Path of each image in the image store, NULL once it has been evicted.
+    Images archived before the store was sharded live under their own filename.
+    '''
+    columns = [row[1] for row in con.execute('PRAGMA table_info(gen_log)')]
+    if 'storage' not in columns:
+        con.execute('ALTER TABLE gen_log ADD COLUMN storage VARCHAR')
+    con.execute('UPDATE gen_log SET storage = filename WHERE storage IS NULL')
+    con.execute('CREATE INDEX IF NOT EXISTS gen_log_storage ON gen_log (storage, timestamp)')
+
+
+JOBS = '''
+-- Generation requests waiting for, or being rendered by, a worker
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created DATETIME DEFAULT CURRENT_TIMESTAMP,
+    userchat_id INTEGER NOT NULL,
+    user VARCHAR NOT NULL,
+    telegram_chat_id INTEGER NOT NULL,
+    chat_type VARCHAR NOT NULL,
+    message_id INTEGER,
+    image_type VARCHAR NOT NULL,
+    prompt VARCHAR NOT NULL,
+    request VARCHAR NOT NULL,
+    state VARCHAR NOT NULL DEFAULT 'queued',
+    worker VARCHAR,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error VARCHAR,
+    finished DATETIME,
+    FOREIGN KEY (userchat_id) REFERENCES userchats(userchat_id)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, userchat_id);
+'''
+
+
+def add_gen_log_job_id(con: apsw.Connection):
+    '''
+    The job that produced each image, so a restarted job can tell it was already delivered.
+    '''
+    columns = [row[1] for row in con.execute('PRAGMA table_info(gen_log)')]
+    if 'job_id' not in columns:
+        con.execute('ALTER TABLE gen_log ADD COLUMN job_id INTEGER REFERENCES jobs(job_id)')
+    con.execute('CREATE INDEX IF NOT EXISTS gen_log_job_id ON gen_log (job_id)')
+
+
+RATE_LIMITS = '''
+-- Token buckets of the rate limiter that were not full when last saved
+CREATE TABLE IF NOT EXISTS rate_limits (
+    scope VARCHAR NOT NULL,
+    key VARCHAR NOT NULL,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (scope, key)
+);
+'''
+
+
+def add_jobs_priority(con: apsw.Connection):
+    '''
+    The priority class of each job and the effective priority it had when it started, after aging.
+    '''
+    columns = [row[1] for row in con.execute('PRAGMA table_info(jobs)')]
+    if 'priority' not in columns:
+        con.execute('ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 3')
+    if 'effective_priority' not in columns:
+        con.execute('ALTER TABLE jobs ADD COLUMN effective_priority REAL')
+
+
+MIGRATIONS = [
+    (1, 'baseline schema', BASELINE),
+    (2, 'gen_log.file_id', add_gen_log_file_id),
+    (3, 'userchats.chat_id as INTEGER', USERCHATS_INTEGER_CHAT_ID),
+    (4, 'gen_log and users indexes', INDEXES),
+    (5, 'gen_log.storage', add_gen_log_storage),
+    (6, 'jobs table', JOBS),
+    (7, 'gen_log.job_id', add_gen_log_job_id),
+    (8, 'rate_limits table', RATE_LIMITS),
+    (9, 'jobs.priority', add_jobs_priority),
+]
+
+
+class MigrationRunner:
+    def __init__(self, database: str):
+        self.database = database
+        self.logger = logging.getLogger(__name__)
+
+    def version(self, con: apsw.Connection) -> int:
+        '''
+        The schema version of the database.
+        '''
+        return con.execute('PRAGMA user_version').fetchone()[0]
+
+    def run(self) -> int:
+        '''
+        Apply every pending migration in order.
+        Returns the resulting schema version.
+        '''
+        con = apsw.Connection(self.database)
+        try:
+            version = self.version(con)
+            for number, description, step in MIGRATIONS:
+                if number <= version:
+                    continue
+                self.logger.info(f'Applying migration {number}: {description}')
+                with con:
+                    if callable(step):
+                        step(con)
+                    else:
+                        con.execute(step)
+                    con.execute(f'PRAGMA user_version = {number}')
+                version = number
+            return version
+        finally:
+            con.close()
@@ -0,0 +1,104 @@
+import asyncio
+import base64
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+from telegram.error import TelegramError
+
+
+DEFAULT_SIZE = 512
+INIT_IMAGE_QUALITY = 95
+DEFAULT_DOWNLOAD_TIMEOUT = 30.0
+DEFAULT_MAX_DOWNLOAD_BYTES = 10 * 1024 * 1024
+
+
+class SourceImageError(Exception):
+    '''
+    Raised when a source photo is missing or can't be downloaded or read.
+    '''
+
+
+class ImagePreprocessor:
+    '''
+    Prepares /variation input photos for img2img.
+    Picks the smallest Telegram photo size that still covers the target
+    resolution, downloads it through the bot into memory, then center-crops
+    and resizes it on a worker pool, so neither the download nor the img2img
+    payload is larger than the render needs.
+    '''
+    def __init__(self, width: int = DEFAULT_SIZE, height: int = DEFAULT_SIZE, workers: int = 2,
+                 download_timeout: float = DEFAULT_DOWNLOAD_TIMEOUT, max_download_bytes: int = DEFAULT_MAX_DOWNLOAD_BYTES):
+        self.width = width
+        self.height = height
+        self.download_timeout = float(download_timeout)
+        self.max_download_bytes = int(max_download_bytes)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix='preprocess')
+
+        self.logger = logging.getLogger(__name__)
+
+    ###########
+    # Helpers #
+    ###########
+
+    def __check_size(self, size: int):
+        if size and size > self.max_download_bytes:
+            raise SourceImageError(f'The image is larger than {self.max_download_bytes // (1024 * 1024)} MB')
+
+    def __prepare(self, data: bytes) -> str:
+        # Unreadable and truncated images raise OSError, oversized ones a decompression bomb error
+        try:
+            image = ImageOps.exif_transpose(Image.open(io.BytesIO(data))).convert('RGB')
+        except (OSError, Image.DecompressionBombError) as e:
+            raise SourceImageError('The image could not be read') from e
+        if image.size != (self.width, self.height):
+            image = ImageOps.fit(image, (self.width, self.height), method=Image.Resampling.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=INIT_IMAGE_QUALITY)
+        self.logger.debug(f'Prepared {len(data)} byte input as {len(output.getbuffer())} byte {self.width}x{self.height} JPEG')
+        return base64.b64encode(output.getbuffer()).decode('utf-8')
+
+    ##################
+    # Public methods #
+    ##################
+
+    def select(self, photo_sizes: list):
+        '''
+        The smallest photo size covering the target resolution, or the largest one available.
+        Raises SourceImageError if there is no photo.
+        '''
+        if not photo_sizes:
+            raise SourceImageError('There is no photo to make a variation of')
+        covering = [size for size in photo_sizes if size.width >= self.width and size.height >= self.height]
+        if covering:
+            return min(covering, key=lambda size: size.width * size.height)
+        return max(photo_sizes, key=lambda size: size.width * size.height)
+
+    async def download(self, photo) -> bytes:
+        '''
+        Download a photo size into memory.
+        Raises SourceImageError if it is too large or Telegram fails or times out.
+        '''
+        self.__check_size(photo.file_size)
+        timeouts = {'read_timeout': self.download_timeout, 'connect_timeout': self.download_timeout}
+        try:
+            file = await photo.get_file(**timeouts)
+            self.__check_size(file.file_size)
+            data = await file.download_as_bytearray(**timeouts)
+        except TelegramError as e:
+            self.logger.error(f'Error downloading source image {photo.file_unique_id}: {e!r}')
+            raise SourceImageError('The image could not be downloaded') from e
+
+        self.__check_size(len(data))
+        return bytes(data)
+
+    async def prepare(self, data: bytes) -> str:
+        '''
+        Crop and resize an image to the target resolution and base64 encode it for img2img.
+        Raises SourceImageError if the data is not an image.
+        '''
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.__prepare, data)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,45 @@
+import logging
+
+
+# Lower classes are served first
+VIP = 0
+DRAFT = 1
+PRIVATE = 2
+GROUP = 3
+
+
+class PriorityPolicy:
+    '''
+    Maps a generation request to a priority class.
+    Requests of VIP users come first, then cheap draft renders (at most
+    draft_steps steps), then private chats and finally groups. Waiting jobs
+    age: every aging seconds in the queue lifts a job one class, so low
+    priority jobs can't starve.
+    '''
+    def __init__(self, vip_users: list = None, draft_steps: int = 10, aging: float = 30.0):
+        self.vip_users = {user.lstrip('@').lower() for user in vip_users or [] if user}
+        self.draft_steps = draft_steps
+        self.aging = aging
+
+        self.logger = logging.getLogger(__name__)
+
+    def classify(self, user: dict, chat_type: str, steps: int) -> int:
+        '''
+        The priority class of a request.
+        '''
+        if (user.get('username') or '').lower() in self.vip_users:
+            return VIP
+        if steps <= self.draft_steps:
+            return DRAFT
+        if chat_type == 'private':
+            return PRIVATE
+        return GROUP
+
+    def effective(self, priority: int, waited: float) -> int:
+        '''
+        The priority of a job that has waited for waited seconds.
+        Jobs age in whole classes, so jobs of the same class still tie and take turns.
+        '''
+        if not self.aging:
+            return priority
+        return max(0, priority - int(waited // self.aging))
@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+USER = 'user'
+CHAT = 'chat'
+GLOBAL = 'global'
+
+
+class TokenBucket:
+    '''
+    Holds up to capacity tokens, refilled at rate tokens per second.
+    '''
+    def __init__(self, capacity: float, rate: float, tokens: float = None, updated: float = None):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity if tokens is None else min(tokens, capacity)
+        self.updated = time.time() if updated is None else updated
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost: float) -> float:
+        '''
+        Seconds until cost tokens are available; 0 if they are now.
+        '''
+        missing = min(cost, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    @property
+    def full(self) -> bool:
+        return self.tokens >= self.capacity
+
+
+class RateLimiter:
+    '''
+    Token bucket admission control per user, per chat and for the whole bot.
+    A request is admitted only if every bucket it draws from has enough tokens,
+    and then takes them from all of them. Each scope is configured with a rate
+    per minute and a burst size; a rate of 0 disables the scope. Idle buckets
+    are dropped once a scope holds more than max_buckets of them.
+    '''
+    def __init__(self, limits: dict, max_buckets: int = 10000):
+        # limits maps a scope to its (rate per minute, burst)
+        self.limits = {scope: (rate / 60, max(1, burst)) for scope, (rate, burst) in limits.items() if rate > 0}
+        self.max_buckets = max_buckets
+        self.buckets = {scope: OrderedDict() for scope in self.limits}
+        self.lock = threading.Lock()
+
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.limits)
+
+    ###########
+    # Helpers #
+    ###########
+
+    def __bucket(self, scope: str, key: str, now: float) -> TokenBucket:
+        buckets = self.buckets[scope]
+        bucket = buckets.get(key)
+        if bucket is None:
+            rate, burst = self.limits[scope]
+            bucket = TokenBucket(burst, rate, updated=now)
+            buckets[key] = bucket
+            while len(buckets) > self.max_buckets:
+                buckets.popitem(last=False)
+        else:
+            buckets.move_to_end(key)
+            bucket.refill(now)
+        return bucket
+
+    ##################
+    # Public methods #
+    ##################
+
+    def admit(self, user: str, chat: str, cost: float = 1) -> float:
+        '''
+        Take cost tokens from the user's, the chat's and the global bucket.
+        Returns 0 if the request is admitted, otherwise the seconds to wait before retrying.
+        '''
+        keys = {USER: user, CHAT: chat, GLOBAL: GLOBAL}
+        now = time.time()
+        with self.lock:
+            buckets = [self.__bucket(scope, str(keys[scope]), now) for scope in self.limits]
+            wait = max((bucket.wait_time(cost) for bucket in buckets), default=0.0)
+            if wait > 0:
+                return wait
+            for bucket in buckets:
+                bucket.tokens -= min(cost, bucket.capacity)
+            return 0.0
+
+    def refund(self, user: str, chat: str, cost: float = 1):
+        '''
+        Give back the tokens of an admitted request that was rejected later on.
+        Buckets dropped in the meantime are already full and are left alone.
+        '''
+        keys = {USER: user, CHAT: chat, GLOBAL: GLOBAL}
+        now = time.time()
+        with self.lock:
+            for scope in self.limits:
+                bucket = self.buckets[scope].get(str(keys[scope]))
+                if bucket is not None:
+                    bucket.refill(now)
+                    bucket.tokens = min(bucket.capacity, bucket.tokens + min(cost, bucket.capacity))
+
+    def snapshot(self) -> list:
+        '''
+        The (scope, key, tokens, updated) rows of every bucket that isn't full.
+        Full buckets are what a missing bucket starts as, so they aren't worth keeping.
+        '''
+        now = time.time()
+        rows = []
+        with self.lock:
+            for scope, buckets in self.buckets.items():
+                for key, bucket in buckets.items():
+                    bucket.refill(now)
+                    if not bucket.full:
+                        rows.append((scope, key, bucket.tokens, bucket.updated))
+        return rows
+
+    def restore(self, rows: list):
+        '''
+        Load buckets saved with snapshot; rows of disabled scopes are ignored.
+        '''
+        with self.lock:
+            for scope, key, tokens, updated in rows:
+                if scope not in self.limits:
+                    continue
+                rate, burst = self.limits[scope]
+                self.buckets[scope][key] = TokenBucket(burst, rate, tokens=tokens, updated=updated)
+        self.logger.debug(f'Restored {len(rows)} rate limit buckets')
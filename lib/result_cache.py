@@ -0,0 +1,192 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+from collections import OrderedDict
+
+from .stable_diffusion import GeneratedImage
+
+
+CACHE_DIRECTORY = "/app/data/cache"
+
+
+class ResultCache:
+    '''
+    Content-addressed cache of generation results.
+    Entries are keyed by the hash of the full SD payload and stored on disk
+    next to a JSON index kept in least-recently-used order. The cache is
+    bounded by entry count and total bytes; the oldest entries are evicted first.
+    '''
+    def __init__(self, directory: str = CACHE_DIRECTORY, max_entries: int = 500, max_bytes: int = 500 * 1024 * 1024):
+        self.directory = directory
+        self.index_path = os.path.join(directory, 'index.json')
+        self.max_entries = max(0, int(max_entries))
+        self.max_bytes = max(0, int(max_bytes))
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = asyncio.Lock()
+
+        self.logger = logging.getLogger(__name__)
+        self.__load_index()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    @property
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.size}
+
+    ###########
+    # Helpers #
+    ###########
+
+    def __load_index(self):
+        '''
+        Load the index from disk, dropping entries whose files are gone.
+        '''
+        if not self.enabled:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.index_path, 'r') as file:
+                entries = json.load(file)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            self.logger.error(f'Error loading result cache index: {e}')
+            return
+
+        for key, entry in entries:
+            if all(os.path.exists(os.path.join(self.directory, name)) for name in entry['files']):
+                self.entries[key] = entry
+                self.size += entry['size']
+
+    def __save_index(self):
+        '''
+        Write the index atomically.
+        '''
+        entries = json.dumps(list(self.entries.items()))
+        temp_path = f'{self.index_path}.tmp'
+        with open(temp_path, 'w') as file:
+            file.write(entries)
+        os.replace(temp_path, self.index_path)
+
+    def __read(self, entry: dict) -> list:
+        images = []
+        file_ids = entry.get('file_ids') or [None] * len(entry['files'])
+        for name, parameters, file_id in zip(entry['files'], entry['parameters'], file_ids):
+            with open(os.path.join(self.directory, name), 'rb') as file:
+                images.append(GeneratedImage(data=file.read(), parameters=parameters, filename=f"{uuid.uuid4().hex}.png", file_id=file_id))
+        return images
+
+    def __write(self, images: list) -> list:
+        names = []
+        for image in images:
+            name = f'{uuid.uuid4().hex}.png'
+            with open(os.path.join(self.directory, name), 'wb') as file:
+                file.write(image.data)
+            names.append(name)
+        return names
+
+    def __remove(self, entries: list):
+        for entry in entries:
+            for name in entry['files']:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+    def __evict(self) -> list:
+        '''
+        Drop least recently used entries until the cache is within its limits.
+        '''
+        evicted = []
+        while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry['size']
+            evicted.append(entry)
+        return evicted
+
+    ##################
+    # Public methods #
+    ##################
+
+    async def get(self, key: str):
+        '''
+        The cached images for key, or None on a miss.
+        '''
+        if not self.enabled:
+            return None
+
+        async with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                self.logger.info(f'Result cache miss ({self.stats})')
+                return None
+            self.entries.move_to_end(key)
+
+            try:
+                images = await asyncio.to_thread(self.__read, entry)
+            except OSError as e:
+                self.logger.error(f'Error reading cached result: {e}')
+                self.size -= self.entries.pop(key)['size']
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.logger.info(f'Result cache hit ({self.stats})')
+            return images
+
+    async def put(self, key: str, images: list):
+        '''
+        Store the images generated for key.
+        '''
+        if not self.enabled or not images:
+            return
+
+        async with self.lock:
+            if key in self.entries:
+                return
+            try:
+                names = await asyncio.to_thread(self.__write, images)
+            except OSError as e:
+                self.logger.error(f'Error writing cached result: {e}')
+                return
+
+            entry = {
+                'files': names,
+                'parameters': [image.parameters for image in images],
+                'file_ids': [image.file_id for image in images],
+                'size': sum(len(image.data) for image in images),
+            }
+            self.entries[key] = entry
+            self.size += entry['size']
+            evicted = self.__evict()
+
+            try:
+                await asyncio.to_thread(self.__remove, evicted)
+                await asyncio.to_thread(self.__save_index)
+            except OSError as e:
+                self.logger.error(f'Error updating result cache index: {e}')
+
+    async def set_file_ids(self, key: str, file_ids: list):
+        '''
+        Remember the Telegram file_ids of a cached result so hits skip the upload.
+        '''
+        if not self.enabled:
+            return
+
+        async with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.get('file_ids') == file_ids:
+                return
+            entry['file_ids'] = file_ids
+            try:
+                await asyncio.to_thread(self.__save_index)
+            except OSError as e:
+                self.logger.error(f'Error updating result cache index: {e}')
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+
+class QueueFullError(Exception):
+    '''
+    Raised when a job is submitted while the queue is at capacity.
+    '''
+
+
+class Job:
+    '''
+    A queued unit of work for the Stable Diffusion backend.
+    run is an async callable that receives the backend client and the job's
+    effective priority when it started; cost is the job's share of backend work
+    used for load balancing and priority its class (lower runs first).
+    '''
+    def __init__(self, key, run, future: asyncio.Future, cost: int = 1, priority: int = 0):
+        self.key = key
+        self.run = run
+        self.future = future
+        self.cost = cost
+        self.priority = priority
+        self.queued = time.monotonic()
+
+
+class JobScheduler:
+    '''
+    Bounded in-process queue in front of the Stable Diffusion backend pool.
+    The next job is the oldest job of the key whose oldest job has the best effective
+    priority (see PriorityPolicy); keys tied on priority are served round-robin across
+    keys (userchat ids) so a busy chat can't starve the others. The pool limits how many
+    jobs each backend runs at the same time.
+    '''
+    def __init__(self, pool, max_queue_size: int = 50, priorities=None):
+        self.pool = pool
+        self.priorities = priorities
+        self.concurrency = pool.capacity
+        self.max_queue_size = max(1, int(max_queue_size))
+        self.queues = OrderedDict()
+        self.size = 0
+        self.running = 0
+        self.workers = []
+        self.available = None
+
+        self.logger = logging.getLogger(__name__)
+
+    ###########
+    # Helpers #
+    ###########
+
+    def __ensure_workers(self):
+        '''
+        Start the worker tasks on the running event loop.
+        '''
+        if self.workers:
+            return
+        self.available = asyncio.Semaphore(0)
+        self.workers = [asyncio.create_task(self.__worker()) for _ in range(self.concurrency)]
+
+    def __effective(self, job: Job, now: float) -> int:
+        if self.priorities is None:
+            return job.priority
+        return self.priorities.effective(job.priority, now - job.queued)
+
+    def __position(self, key, priority: int) -> int:
+        '''
+        Estimated number of queued jobs that will be served before a new job for key.
+        Keys waiting on a worse priority are assumed to go after it.
+        '''
+        now = time.monotonic()
+        own = len(self.queues.get(key, ()))
+        ahead = 0
+        seen_key = False
+        for other, queue in self.queues.items():
+            if other == key:
+                seen_key = True
+                continue
+            if self.__effective(queue[0], now) > priority:
+                continue
+            # Keys after ours in the rotation get one fewer turn before our job
+            ahead += min(len(queue), own if seen_key else own + 1)
+        return ahead + own
+
+    def __next_job(self) -> tuple:
+        '''
+        Pop the next job: the best effective priority first, rotating across keys on ties.
+        Returns the job and its effective priority.
+        '''
+        now = time.monotonic()
+        # min keeps the first of equal keys, which is the next one in the rotation
+        key = min(self.queues, key=lambda key: self.__effective(self.queues[key][0], now))
+        queue = self.queues[key]
+        priority = self.__effective(queue[0], now)
+        job = queue.popleft()
+        if queue:
+            self.queues.move_to_end(key)
+        else:
+            del self.queues[key]
+        self.size -= 1
+        return job, priority
+
+    async def __worker(self):
+        '''
+        Take jobs off the queue and run them against the backend.
+        '''
+        while True:
+            await self.available.acquire()
+            job, priority = self.__next_job()
+            if job.future.done():
+                # The requester went away while waiting
+                continue
+
+            self.running += 1
+            try:
+                async with self.pool.lease(job.cost) as sd:
+                    result = await job.run(sd, priority)
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self.running -= 1
+
+    ##################
+    # Public methods #
+    ##################
+
+    def submit(self, key, run, cost: int = 1, priority: int = 0):
+        '''
+        Queue a job for key with a priority class.
+        Returns (position, future); position is 0 when the job starts right away.
+        Raises QueueFullError if the queue is at capacity.
+        '''
+        if self.size >= self.max_queue_size:
+            raise QueueFullError(f'Queue is full ({self.size} jobs)')
+
+        self.__ensure_workers()
+        # Jobs ahead of us that idle workers are about to pick up don't count as waiting
+        waiting = self.__position(key, priority) - max(0, self.concurrency - self.running)
+        position = waiting + 1 if waiting >= 0 else 0
+
+        job = Job(key, run, asyncio.get_running_loop().create_future(), cost, priority)
+        self.queues.setdefault(key, deque()).append(job)
+        self.size += 1
+        self.available.release()
+
+        self.logger.debug(f'Queued job for {key} with priority {priority}, position {position}, queue size {self.size}')
+        return position, job.future
+
+    async def close(self):
+        '''
+        Stop the workers and fail every queued job.
+        '''
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+        for queue in self.queues.values():
+            for job in queue:
+                job.future.cancel()
+        self.queues.clear()
+        self.size = 0
@@ -0,0 +1,44 @@
+import asyncio
+import logging
+
+
+class SingleFlight:
+    '''
+    Merges identical in-flight calls.
+    The first caller for a key registers the future of its call; later callers
+    with the same key wait on that future instead of starting their own.
+    '''
+    def __init__(self):
+        self.calls = {}
+        self.merged = 0
+
+        self.logger = logging.getLogger(__name__)
+
+    def __forget(self, key, future: asyncio.Future):
+        # A newer call for the same key may have been registered since
+        if self.calls.get(key) is future:
+            del self.calls[key]
+
+    def get(self, key):
+        '''
+        The in-flight future for key, or None.
+        '''
+        future = self.calls.get(key)
+        if future is not None:
+            self.merged += 1
+            self.logger.debug(f'Merged request {key[:12]} into an in-flight call ({self.merged} merged so far)')
+        return future
+
+    def register(self, key, future: asyncio.Future) -> asyncio.Future:
+        '''
+        Track future as the in-flight call for key until it completes.
+        '''
+        self.calls[key] = future
+        future.add_done_callback(lambda _: self.__forget(key, future))
+        return future
+
+    async def wait(self, future: asyncio.Future):
+        '''
+        Wait for a shared call without cancelling it for the other waiters.
+        '''
+        return await asyncio.shield(future)
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import os
+import re
+from collections import OrderedDict
+
+
+SOURCE_DIRECTORY = "/app/data/sources"
+
+
+class SourceCache:
+    '''
+    Cache of prepared img2img source images keyed by Telegram file_unique_id.
+    Holds the base64 encoded, already resized source so repeated /variation
+    runs on the same photo skip both the download and the preprocessing.
+    The most recently used entries are kept in memory; entries pushed out of
+    memory spill to disk, where the least recently used are removed past
+    max_disk_entries.
+    '''
+    def __init__(self, directory: str = SOURCE_DIRECTORY, max_entries: int = 32, max_disk_entries: int = 256):
+        self.directory = directory
+        self.max_entries = max(0, int(max_entries))
+        self.max_disk_entries = max(0, int(max_disk_entries))
+        self.memory = OrderedDict()
+        self.disk = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = asyncio.Lock()
+
+        self.logger = logging.getLogger(__name__)
+        self.__load()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    @property
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'memory': len(self.memory), 'disk': len(self.disk)}
+
+    ###########
+    # Helpers #
+    ###########
+
+    def __load(self):
+        '''
+        Pick up entries spilled by a previous run, oldest first.
+        '''
+        if not self.enabled or not self.max_disk_entries:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            paths = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.b64')]
+        except OSError as e:
+            self.logger.error(f'Error loading source cache: {e}')
+            return
+        for entry in sorted(paths, key=lambda entry: entry.stat().st_mtime):
+            self.disk[entry.name[:-len('.b64')]] = True
+
+    def __path(self, key: str) -> str:
+        # file_unique_ids are url-safe base64, but never trust a name that ends up in a path
+        return os.path.join(self.directory, f"{re.sub(r'[^A-Za-z0-9_-]', '_', key)}.b64")
+
+    def __read(self, key: str) -> str:
+        with open(self.__path(key), 'r') as file:
+            return file.read()
+
+    def __write(self, items: list):
+        for key, value in items:
+            with open(self.__path(key), 'w') as file:
+                file.write(value)
+
+    def __remove(self, keys: list):
+        for key in keys:
+            try:
+                os.remove(self.__path(key))
+            except FileNotFoundError:
+                pass
+
+    async def __spill(self):
+        '''
+        Move entries over the memory limit to disk and trim the disk entries.
+        '''
+        spilled = []
+        while len(self.memory) > self.max_entries:
+            spilled.append(self.memory.popitem(last=False))
+        if not self.max_disk_entries:
+            return
+
+        for key, _ in spilled:
+            self.disk[key] = True
+            self.disk.move_to_end(key)
+        removed = []
+        while len(self.disk) > self.max_disk_entries:
+            key, _ = self.disk.popitem(last=False)
+            removed.append(key)
+        spilled = [(key, value) for key, value in spilled if key in self.disk]
+
+        try:
+            await asyncio.to_thread(self.__write, spilled)
+            await asyncio.to_thread(self.__remove, removed)
+        except OSError as e:
+            self.logger.error(f'Error spilling source cache to disk: {e}')
+
+    ##################
+    # Public methods #
+    ##################
+
+    async def get(self, key: str):
+        '''
+        The cached base64 source for key, or None on a miss.
+        '''
+        if not self.enabled:
+            return None
+
+        async with self.lock:
+            value = self.memory.get(key)
+            if value is not None:
+                self.memory.move_to_end(key)
+            elif key in self.disk:
+                try:
+                    value = await asyncio.to_thread(self.__read, key)
+                except OSError as e:
+                    self.logger.error(f'Error reading cached source: {e}')
+                del self.disk[key]
+                if value is not None:
+                    # Promoted back to memory; the file is rewritten if it spills again
+                    await asyncio.to_thread(self.__remove, [key])
+                    self.memory[key] = value
+                    await self.__spill()
+
+            if value is None:
+                self.misses += 1
+                self.logger.debug(f'Source cache miss ({self.stats})')
+                return None
+            self.hits += 1
+            self.logger.debug(f'Source cache hit ({self.stats})')
+            return value
+
+    async def put(self, key: str, value: str):
+        '''
+        Store the base64 source for key.
+        '''
+        if not self.enabled:
+            return
+
+        async with self.lock:
+            self.memory[key] = value
+            self.memory.move_to_end(key)
+            await self.__spill()
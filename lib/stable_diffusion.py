@@ -1,99 +1,233 @@
-import requests
+import httpx
 import json
-import io
 import base64
-from PIL import Image, PngImagePlugin
+import hashlib
+from dataclasses import dataclass, field
 import logging
 import uuid
-import base64
-
 
 
-class StableDiffusion:
-    def __init__(self, url, steps):
-        self.url = url
-        self.steps = steps
+FIXED_PROMPT = " 8k, high-resolution, photorealistic"
+FIXED_NEGATIVE_PROMPT = "low-resolution, pixelated, blurry, bad quality, distorted, many fingers, many limbs, misshapen body, weird face, distorted face, ugly"
+
+DEFAULT_TIMEOUT = 300.0
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_MAX_CONNECTIONS = 4
+
+
+@dataclass
+class GenerationRequest:
+    '''
+    A single txt2img or img2img request to the Stable Diffusion API.
+    Requests with init images are sent to img2img.
+    '''
+    prompt: str
+    negative_prompt: str = FIXED_NEGATIVE_PROMPT
+    steps: int = 20
+    width: int = 512
+    height: int = 512
+    batch_size: int = 1
+    n_iter: int = 1
+    seed: int = -1
+    init_images: list = field(default_factory=list)
+
+    @classmethod
+    def new_image(cls, prompt: str, steps: int, count: int = 1, seed: int = -1):
+        '''
+        A txt2img request for count images of a prompt.
+        '''
+        return cls(prompt=prompt+FIXED_PROMPT, steps=steps, batch_size=count, seed=seed)
 
-    def generate_image(self, prompt, height="512", width="512", username=""):
+    @classmethod
+    def variation(cls, image: str, prompt: str, steps: int, count: int = 1, seed: int = -1):
         '''
-        Generates an image from a prompt.
-        Returns the raw data of the image and the pnginfo.
+        An img2img request for count variations of an image.
+        image is the base64 encoded source image.
         '''
+        return cls(prompt=prompt, steps=steps, batch_size=count, seed=seed, init_images=[image])
 
-        endpoint = "/sdapi/v1/txt2img"
+    @property
+    def image_count(self) -> int:
+        return self.batch_size * self.n_iter
 
-        fixed_prompt = " 8k, high-resolution, photorealistic"
-        fixed_negative_prompt = "low-resolution, pixelated, blurry, bad quality, distorted, many fingers, many limbs, misshapen body, weird face, distorted face, ugly"
+    @property
+    def endpoint(self) -> str:
+        return "/sdapi/v1/img2img" if self.init_images else "/sdapi/v1/txt2img"
 
+    @property
+    def cacheable(self) -> bool:
+        '''
+        Only requests with a pinned seed are reproducible.
+        '''
+        return self.seed != -1
+
+    def key(self) -> str:
+        '''
+        A hash of the full payload; identical requests share the same key.
+        '''
+        payload = json.dumps(self.to_payload(), sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def to_payload(self) -> dict:
         payload = {
-            "prompt": prompt+fixed_prompt,
-            "negative_prompt": fixed_negative_prompt,
-            # "steps": 150,
+            "prompt": self.prompt,
+            "negative_prompt": self.negative_prompt,
             "steps": self.steps,
-            "width": 512,
-            "height": 512,
+            "width": self.width,
+            "height": self.height,
+            "batch_size": self.batch_size,
+            "n_iter": self.n_iter,
+            "seed": self.seed,
+            # Only the individual images are wanted, not the preview grid
+            "do_not_save_grid": True,
             #"refiner_checkpoint": "lrmLiangyiusRealistic_v15.safetensors",
             #"refiner_switch_at": 0.85,
         }
-        logging.debug(f"Payload: {payload}")
-
-        response = requests.post(url=f'{self.url}{endpoint}', json=payload)
-        r = response.json()
-        for i in r['images']:
-            image = Image.open(io.BytesIO(base64.b64decode(i.split(",",1)[0])))
-            # image = BytesIO()
-            logging.debug(f"Image: created")
-            png_payload = {
-                "image": "data:image/png;base64," + i
-            }
-            r2 = requests.post(url=f'{self.url}/sdapi/v1/png-info', json=png_payload)
-            logging.debug("got png info")
-            pnginfo = PngImagePlugin.PngInfo()
-            pnginfo.add_text("parameters", r2.json().get("info"))
-
-            filename = uuid.uuid4().hex
-            image.save(f"/app/data/images/{filename}.png", pnginfo=pnginfo)
-
-            return(f"{filename}.png")
-
-    def generate_image_variation(self, image, height="512", width="512", username="", prompt=""):
+        if self.init_images:
+            payload["init_images"] = self.init_images
+        return payload
+
+
+@dataclass
+class GenerationResponse:
+    '''
+    The decoded response of a txt2img or img2img call.
+    images holds the base64 encoded PNGs, info the raw info JSON string.
+    '''
+    images: list
+    parameters: dict
+    info: str
+
+    def infotext(self, index: int = 0) -> str:
         '''
-        Generates an image variation from an image using a prompt.
-        Returns the raw data of the image and the pnginfo.
+        The "parameters" text A1111 embeds in the PNG of the image at index.
+        Built from the info field, so no /sdapi/v1/png-info round trip is needed.
         '''
+        try:
+            info = json.loads(self.info) if self.info else {}
+        except ValueError:
+            info = {}
+
+        infotexts = info.get('infotexts') or []
+        if index < len(infotexts):
+            return infotexts[index]
+
+        # Older servers don't send infotexts; assemble the same format from the fields
+        def pick(key, fallback):
+            values = info.get(f'all_{key}s')
+            if values and index < len(values):
+                return values[index]
+            return info.get(key, fallback)
+
+        prompt = pick('prompt', self.parameters.get('prompt', ''))
+        negative_prompt = pick('negative_prompt', self.parameters.get('negative_prompt', ''))
+        fields = {
+            'Steps': info.get('steps', self.parameters.get('steps')),
+            'Sampler': info.get('sampler_name'),
+            'CFG scale': info.get('cfg_scale'),
+            'Seed': pick('seed', None),
+            'Size': f"{info.get('width', self.parameters.get('width'))}x{info.get('height', self.parameters.get('height'))}",
+            'Model hash': info.get('sd_model_hash'),
+            'Model': info.get('sd_model_name'),
+            'Denoising strength': info.get('denoising_strength') if self.parameters.get('init_images') else None,
+            'Version': info.get('version'),
+        }
+        text = prompt
+        if negative_prompt:
+            text += f"\nNegative prompt: {negative_prompt}"
+        text += "\n" + ", ".join(f"{key}: {value}" for key, value in fields.items() if value is not None)
+        return text
+
+
+@dataclass
+class GeneratedImage:
+    '''
+    A decoded image ready for delivery.
+    data holds the PNG bytes as returned by the server, parameters its infotext
+    and filename the name it is archived and logged under. file_id is set once
+    Telegram has the image, so it can be resent without uploading it again.
+    '''
+    data: bytes
+    parameters: str
+    filename: str
+    file_id: str = None
 
-        endpoint = "/sdapi/v1/img2img"
-
-        fixed_negative_prompt = "low-resolution, pixelated, blurry, bad quality, distorted, many fingers, many limbs, misshapen body, weird face, distorted face, ugly"
 
-        base64_string = base64.b64encode(image).decode('utf-8')
+class StableDiffusion:
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT, max_connections=DEFAULT_MAX_CONNECTIONS):
+        self.url = url.rstrip('/')
+        self.timeout = float(timeout)
+        self.logger = logging.getLogger(__name__)
+
+        # One pooled client for the lifetime of the bot, so renders reuse keep-alive connections
+        self.client = httpx.AsyncClient(
+            base_url=self.url,
+            timeout=httpx.Timeout(self.timeout, connect=DEFAULT_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    async def close(self):
+        '''
+        Close the underlying connection pool.
+        '''
+        await self.client.aclose()
 
-        payload = {
-            "prompt": prompt,
-            "negative_prompt": fixed_negative_prompt,
-            "init_images": [base64_string],
-            # "steps": 150,
-            "steps": self.steps,
-            "width": 512,
-            "height": 512,
-            # "refiner_checkpoint": "lrmLiangyiusRealistic_v15.safetensors",
-            # "refiner_switch_at": 0.85,
-        }
-        response = requests.post(url=f'{self.url}{endpoint}', json=payload)
+    async def ping(self, timeout: float = DEFAULT_CONNECT_TIMEOUT) -> bool:
+        '''
+        Check that the server is up using a cheap endpoint.
+        '''
+        try:
+            response = await self.client.get(
+                '/sdapi/v1/progress',
+                params={'skip_current_image': 'true'},
+                timeout=timeout,
+            )
+            return response.status_code == 200
+        except httpx.HTTPError as e:
+            self.logger.debug(f'Health check for {self.url} failed: {e!r}')
+            return False
+
+    async def submit(self, request: GenerationRequest, timeout: float = None) -> GenerationResponse:
+        '''
+        Send a generation request and return the decoded response.
+        Raises httpx.HTTPError on connection errors, timeouts and non-2xx responses.
+        '''
+        payload = request.to_payload()
+        self.logger.debug(f"Payload: {dict(payload, init_images=len(request.init_images))}")
+
+        response = await self.client.post(
+            request.endpoint,
+            json=payload,
+            timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT,
+        )
+        response.raise_for_status()
         r = response.json()
-        for i in r['images']:
-            image = Image.open(io.BytesIO(base64.b64decode(i.split(",",1)[0])))
-            # image = BytesIO()
-            logging.debug(f"Image: created")
-            png_payload = {
-                "image": "data:image/png;base64," + i
-            }
-            r2 = requests.post(url=f'{self.url}/sdapi/v1/png-info', json=png_payload)
-            logging.debug("got png info")
-            pnginfo = PngImagePlugin.PngInfo()
-            pnginfo.add_text("parameters", r2.json().get("info"))
+        return GenerationResponse(
+            images=r.get('images') or [],
+            parameters=r.get('parameters') or {},
+            info=r.get('info') or '',
+        )
+
+    def __decode_images(self, request: GenerationRequest, response: GenerationResponse) -> list:
+        '''
+        Decode every image of a response.
+        '''
+        images = []
+        # Skip a leading grid image if the server sent one anyway
+        first = max(0, len(response.images) - request.image_count)
+        for index in range(first, len(response.images)):
+            i = response.images[index]
+            data = base64.b64decode(i.split(",",1)[-1])
+            logging.debug(f"Image: decoded")
 
             filename = uuid.uuid4().hex
-            image.save(f"/app/data/images/{filename}.png", pnginfo=pnginfo)
+            images.append(GeneratedImage(data=data, parameters=response.infotext(index), filename=f"{filename}.png"))
+        return images
 
-            return(f"{filename}.png")
+    async def generate(self, request: GenerationRequest) -> list:
+        '''
+        Runs a generation request.
+        Returns the list of decoded images.
+        '''
+        response = await self.submit(request)
+        return self.__decode_images(request, response)
@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import os
+import signal
+import socket
+
+import httpx
+from telegram import Bot, ReplyParameters
+from telegram.error import TelegramError
+
+from .async_dataprocessor import AsyncDataProcessor
+from .backend_pool import BackendPool, BackendUnavailableError
+from .delivery import DeliveryEncoder, ImageDelivery
+from .image_store import ImageStore
+from .jobs import GenerationJob, QUEUED, DONE, FAILED
+from .result_cache import CACHE_DIRECTORY, ResultCache
+
+
+class GenerationWorker:
+    '''
+    Renders generation jobs queued in the jobs table by the bot (ROLE=bot).
+    Every worker process claims jobs under a lease it keeps renewing while the
+    job runs; if a worker dies, its jobs are claimed again by another worker
+    once the lease runs out. Results are sent straight to the chat through the
+    Bot API, so workers scale independently of the process receiving updates.
+    Jobs are claimed by priority class, aged by priority_aging like in the bot.
+    '''
+    def __init__(self, bot_token: str, database_path: str, stable_diffusion_urls: list, sd_timeout: float, sd_concurrency: int,
+                 health_check_interval: float, result_cache_entries: int, result_cache_bytes: int,
+                 delivery_format: str, delivery_quality: int, encode_workers: int, db_readers: int,
+                 poll_interval: float = 1.0, lease_seconds: float = 60.0, max_attempts: int = 3, max_age: float = 3600.0, priority_aging: float = 30.0):
+        self.bot = Bot(bot_token)
+        self.sd_pool = BackendPool(
+            stable_diffusion_urls,
+            timeout=sd_timeout,
+            concurrency=sd_concurrency,
+            health_interval=health_check_interval
+        )
+        self.name = f'{socket.gethostname()}-{os.getpid()}'
+        # The cache index and size are per process, so workers sharing the data volume don't share a cache
+        self.result_cache = ResultCache(
+            directory=os.path.join(CACHE_DIRECTORY, 'workers', self.name),
+            max_entries=result_cache_entries,
+            max_bytes=result_cache_bytes
+        )
+        self.dp = AsyncDataProcessor(database_path, readers=db_readers)
+        # The bot owns the image store budget (see RequestHandler), workers only write
+        self.image_store = ImageStore(index=self.dp)
+        self.encoder = DeliveryEncoder(delivery_format, quality=delivery_quality, workers=encode_workers)
+        self.delivery = ImageDelivery(self.dp, self.image_store, self.encoder, self.result_cache, cached_spoiler=False)
+
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, int(max_attempts))
+        self.max_age = max_age
+        self.priority_aging = priority_aging
+
+        self.logger = logging.getLogger(__name__)
+
+    ###########
+    # Helpers #
+    ###########
+
+    async def __notify_failure(self, job: GenerationJob):
+        try:
+            await self.bot.send_message(
+                job.chat_id,
+                'Image generation failed, please try again later.',
+                reply_parameters=ReplyParameters(message_id=job.message_id, allow_sending_without_reply=True) if job.message_id else None
+            )
+        except TelegramError as e:
+            self.logger.error(f'Error notifying chat {job.chat_id} of failed job {job.job_id}: {e!r}')
+
+    async def __heartbeat(self, job: GenerationJob):
+        '''
+        Keep the lease on a running job.
+        '''
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            if not await self.dp.renew_job_lease(job.job_id, self.name, self.lease_seconds):
+                self.logger.warning(f'Lost the lease on job {job.job_id}')
+                return
+
+    async def __render(self, job: GenerationJob) -> list:
+        '''
+        Render a job, from the result cache if its seed is pinned.
+        '''
+        request = job.request
+        if request.cacheable:
+            images = await self.result_cache.get(request.key())
+            if images:
+                return images
+
+        async with self.sd_pool.lease(request.image_count) as sd:
+            images = await sd.generate(request)
+
+        if request.cacheable:
+            await self.result_cache.put(request.key(), images)
+        return images
+
+    async def __run(self, job: GenerationJob):
+        '''
+        Render and deliver a claimed job, then record how it ended.
+        '''
+        # A worker may have died between delivering a job and marking it done
+        if job.attempts > 1 and await self.dp.job_delivered(job.job_id):
+            self.logger.info(f'Job {job.job_id} was already delivered')
+            await self.dp.set_job_state(job.job_id, DONE)
+            return
+
+        if job.attempts > self.max_attempts:
+            self.logger.error(f'Giving up on job {job.job_id} after {job.attempts - 1} attempts')
+            await self.dp.set_job_state(job.job_id, FAILED, 'Too many attempts')
+            await self.__notify_failure(job)
+            return
+
+        self.logger.info(f'Running job {job.job_id} (attempt {job.attempts})')
+        heartbeat = asyncio.create_task(self.__heartbeat(job))
+        try:
+            images = await self.__render(job)
+            await self.delivery.deliver(
+                self.bot, job.chat_id, job.message_id, job.user, job.chat_type,
+                job.request, images, job.prompt, job.image_type, job.job_id
+            )
+        except (httpx.HTTPError, BackendUnavailableError) as e:
+            self.logger.error(f'Error generating images for job {job.job_id}: {e!r}')
+            if job.attempts < self.max_attempts:
+                await self.dp.set_job_state(job.job_id, QUEUED, repr(e))
+            else:
+                await self.dp.set_job_state(job.job_id, FAILED, repr(e))
+                await self.__notify_failure(job)
+        except Exception as e:
+            self.logger.error(f'Error running job {job.job_id}: {e!r}')
+            await self.dp.set_job_state(job.job_id, FAILED, repr(e))
+            await self.__notify_failure(job)
+        else:
+            await self.dp.set_job_state(job.job_id, DONE)
+        finally:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+
+    async def __expire(self):
+        '''
+        Periodically drop jobs that waited longer than max_age.
+        '''
+        while True:
+            expired = await self.dp.expire_jobs(self.max_age)
+            if expired:
+                self.logger.warning(f'Dropped {expired} jobs older than {self.max_age} seconds')
+            await asyncio.sleep(max(self.poll_interval, min(self.max_age / 10, 60)))
+
+    async def __slot(self):
+        '''
+        Claim and run jobs one at a time.
+        '''
+        while True:
+            job = await self.dp.claim_job(self.name, self.lease_seconds, self.priority_aging)
+            if job is None:
+                await asyncio.sleep(self.poll_interval)
+                continue
+            await self.__run(job)
+
+    ##################
+    # Public methods #
+    ##################
+
+    async def run(self):
+        '''
+        Run jobs on every backend slot until SIGINT or SIGTERM.
+        Jobs interrupted by a shutdown are picked up again once their lease expires.
+        '''
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopped.set)
+
+        async with self.bot:
+            self.logger.info(f'Worker {self.name} started with {self.sd_pool.capacity} slots')
+            slots = [asyncio.create_task(self.__slot()) for _ in range(self.sd_pool.capacity)]
+            if self.max_age:
+                slots.append(asyncio.create_task(self.__expire()))
+            await stopped.wait()
+
+            self.logger.info(f'Worker {self.name} stopping')
+            for slot in slots:
+                slot.cancel()
+            await asyncio.gather(*slots, return_exceptions=True)
+
+            await self.sd_pool.close()
+            await self.image_store.close()
+            self.encoder.close()
+            await self.dp.close()
@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+
+from lib.async_handlers import RequestHandler
+from lib.jobs import GenerationJob, RUNNING
+from lib.migrations import MigrationRunner
+from lib.stable_diffusion import GeneratedImage, GenerationRequest
+
+
+class FakeBackend:
+    def __init__(self):
+        self.renders = []
+
+    async def generate(self, request: GenerationRequest) -> list:
+        self.renders.append(request.prompt)
+        await asyncio.sleep(0.01)
+        return [GeneratedImage(data=b'png', parameters='parameters', filename='image.png')]
+
+    async def ping(self, *args, **kwargs) -> bool:
+        return True
+
+
+class FakeDelivery:
+    def __init__(self):
+        self.chats = []
+
+    async def deliver(self, bot, chat_id, *args):
+        self.chats.append(chat_id)
+
+
+class FakeBot:
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.messages.append((chat_id, text))
+
+
+@pytest.fixture
+def handler(tmp_path):
+    database = str(tmp_path / 'bot.db')
+    MigrationRunner(database).run()
+    handler = RequestHandler(
+        database_path=database, stable_diffusion_urls=['http://sd'], steps=20, sd_timeout=5, sd_concurrency=1,
+        queue_size=10, health_check_interval=3600, max_images=4, result_cache_entries=0, result_cache_bytes=0,
+        image_store_bytes=0, delivery_format='png', delivery_quality=90, encode_workers=1, download_timeout=5,
+        max_download_bytes=1024 * 1024, source_cache_entries=0, source_cache_disk_entries=0,
+        gen_log_buffer_size=0, gen_log_flush_interval=1, db_readers=1, job_max_attempts=2,
+    )
+    handler.backend = FakeBackend()
+    for backend in handler.sd_pool.backends:
+        backend.sd.generate = handler.backend.generate
+        backend.sd.ping = handler.backend.ping
+    handler.delivery = FakeDelivery()
+    return handler
+
+
+def job(chat_id: int, prompt: str = 'a cat') -> GenerationJob:
+    return GenerationJob(
+        user={'username': f'user{chat_id}', 'full_name': 'User'}, chat_id=chat_id, chat_type='group',
+        message_id=1, image_type='new', prompt=prompt, request=GenerationRequest.new_image(prompt, 20),
+    )
+
+
+def run(handler: RequestHandler, coroutine):
+    async def main():
+        try:
+            return await coroutine()
+        finally:
+            await handler.shutdown(None)
+    return asyncio.run(main())
+
+
+def test_identical_concurrent_submits_render_once(handler):
+    request = GenerationRequest.new_image('a cat', 20)
+
+    async def submit():
+        submits = [
+            handler._RequestHandler__submit({'username': f'user{chat_id}', 'full_name': 'User'}, chat_id, 'group', request, None, 3)
+            for chat_id in (1, 2)
+        ]
+        results = await asyncio.gather(*submits)
+        await asyncio.gather(*(result for _, result, _ in results))
+        return [leader for _, _, leader in results]
+
+    assert sorted(run(handler, submit)) == [False, True]
+    assert handler.backend.renders == ['a cat 8k, high-resolution, photorealistic']
+
+
+def test_identical_resumed_jobs_render_once(handler):
+    async def resume():
+        for chat_id in (1, 2):
+            await handler.dp.enqueue_job(job(chat_id))
+        await handler._RequestHandler__resume_jobs(FakeBot())
+        await asyncio.gather(*handler.resumed)
+        return await handler.dp.unfinished_jobs()
+
+    assert run(handler, resume) == []
+    assert handler.backend.renders == ['a cat 8k, high-resolution, photorealistic']
+    assert sorted(handler.delivery.chats) == [1, 2]
+
+
+def test_resumed_jobs_fail_after_max_attempts(handler):
+    bot = FakeBot()
+
+    async def resume():
+        job_id, _ = await handler.dp.enqueue_job(job(1))
+        # Two runs crashed while rendering the job
+        for _ in range(2):
+            await handler.dp.set_job_state(job_id, RUNNING)
+        await handler._RequestHandler__resume_jobs(bot)
+        return await handler.dp.unfinished_jobs()
+
+    assert run(handler, resume) == []
+    assert handler.backend.renders == []
+    assert bot.messages == [(1, 'Image generation failed, please try again later.')]
@@ -0,0 +1,54 @@
+import asyncio
+
+import httpx
+import pytest
+
+from lib.backend_pool import BackendPool, BackendUnavailableError
+
+
+async def healthy(*args, **kwargs) -> bool:
+    return True
+
+
+def run_failing_job(error: Exception) -> list:
+    '''
+    Fail a job on the first backend with error; returns the health of every backend.
+    '''
+    async def run():
+        pool = BackendPool(['http://sd-a', 'http://sd-b'], timeout=1, health_interval=3600)
+        for backend in pool.backends:
+            backend.sd.ping = healthy
+        try:
+            with pytest.raises(type(error)):
+                async with pool.lease():
+                    raise error
+            return [backend.healthy for backend in pool.backends]
+        finally:
+            await pool.close()
+    return asyncio.run(run())
+
+
+def test_read_timeout_keeps_backend():
+    assert run_failing_job(httpx.ReadTimeout('render took too long')) == [True, True]
+
+
+@pytest.mark.parametrize('error', [httpx.ConnectError('refused'), httpx.ConnectTimeout('unreachable')])
+def test_connection_error_ejects_backend(error):
+    assert run_failing_job(error) == [False, True]
+
+
+def test_acquire_gives_up_when_every_backend_is_down():
+    async def unhealthy(*args, **kwargs) -> bool:
+        return False
+
+    async def run():
+        pool = BackendPool(['http://sd-a'], timeout=0.1, health_interval=3600)
+        pool.backends[0].sd.ping = unhealthy
+        pool.backends[0].healthy = False
+        try:
+            with pytest.raises(BackendUnavailableError):
+                async with pool.lease():
+                    pass
+        finally:
+            await pool.close()
+    asyncio.run(run())
@@ -0,0 +1,99 @@
+import os
+import sqlite3
+
+import apsw
+import pytest
+
+from lib.dataprocessor import DataProcessor
+from lib.jobs import GenerationJob
+from lib.migrations import MIGRATIONS, MigrationRunner
+from lib.stable_diffusion import GenerationRequest
+
+
+BASELINE_SCHEMA = os.path.join(os.path.dirname(__file__), 'baseline_schema.sql')
+USER = {'username': 'alice', 'full_name': 'Alice'}
+
+
+def user_version(database: str) -> int:
+    con = apsw.Connection(database)
+    try:
+        return con.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+        con.close()
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'fresh.db')
+    MigrationRunner(path).run()
+    return path
+
+
+@pytest.fixture
+def baseline_database(tmp_path):
+    '''
+    A database created by the old entrypoint from schema.sql, with one userchat.
+    '''
+    path = str(tmp_path / 'baseline.db')
+    con = sqlite3.connect(path)
+    with open(BASELINE_SCHEMA) as file:
+        con.executescript(file.read())
+    con.execute("INSERT INTO users (username, full_name, is_username) VALUES ('alice', 'Alice', 1)")
+    con.execute('INSERT INTO chats (telegram_chat_id, chat_type_id) VALUES (42, 2)')
+    con.execute("INSERT INTO userchats (user_id, chat_id) VALUES (1, '1')")
+    con.commit()
+    con.close()
+    return path
+
+
+def plans(dp: DataProcessor, call) -> str:
+    '''
+    The query plans of every statement run by call.
+    '''
+    statements = []
+    dp.con.exec_trace = lambda cursor, sql, bindings: statements.append((sql, bindings)) or True
+    try:
+        call()
+    finally:
+        dp.con.exec_trace = None
+
+    details = []
+    for sql, bindings in statements:
+        if sql.split()[0].upper() in ('SELECT', 'INSERT', 'UPDATE', 'DELETE'):
+            details += [row[3] for row in dp.con.execute(f'EXPLAIN QUERY PLAN {sql}', bindings)]
+    return '\n'.join(details)
+
+
+def test_fresh_database_is_migrated(database):
+    assert user_version(database) == len(MIGRATIONS)
+    assert MigrationRunner(database).run() == len(MIGRATIONS)
+
+
+def test_baseline_database_is_migrated(baseline_database):
+    assert MigrationRunner(baseline_database).run() == len(MIGRATIONS)
+    assert user_version(baseline_database) == len(MIGRATIONS)
+
+    con = apsw.Connection(baseline_database)
+    try:
+        assert con.execute('SELECT typeof(chat_id) FROM userchats').fetchall() == [('integer',)]
+    finally:
+        con.close()
+
+    dp = DataProcessor(baseline_database)
+    assert dp.get_userchat_id(USER, 42, 'group') == 1
+    dp.close()
+
+
+def test_lookups_use_indexes(database):
+    dp = DataProcessor(database)
+    dp.log_new_image(USER, 42, 'a.png', 'a cat', 'new', 'group', storage='ab/cd/a.png')
+    dp.enqueue_job(GenerationJob(
+        user=USER, chat_id=42, chat_type='group', message_id=1, image_type='new',
+        prompt='a cat', request=GenerationRequest.new_image('a cat', 20),
+    ))
+
+    assert 'USING INDEX gen_log_userchat_timestamp' in plans(dp, lambda: dp.get_last_image(USER, 42))
+    assert 'INDEX users_full_name' in plans(dp, lambda: dp.get_userchat_id({'username': None, 'full_name': 'Bob'}, 43, 'private'))
+    assert 'USING INDEX jobs_state' in plans(dp, lambda: dp.claim_job('worker', 60, 30))
+    assert 'INDEX gen_log_storage' in plans(dp, lambda: dp.eviction_candidates(10))
+    dp.close()
@@ -0,0 +1,34 @@
+from lib.rate_limiter import RateLimiter
+
+
+def limiter() -> RateLimiter:
+    return RateLimiter({'user': (1, 2), 'chat': (1, 3), 'global': (0, 50)})
+
+
+def test_admit_takes_tokens_from_every_bucket():
+    rate_limiter = limiter()
+
+    assert rate_limiter.admit('alice', 1, 2) == 0
+    assert rate_limiter.admit('alice', 1, 1) > 0
+    assert rate_limiter.admit('bob', 1, 1) == 0
+    assert rate_limiter.admit('bob', 1, 1) > 0
+
+
+def test_refund_returns_the_tokens_of_a_rejected_request():
+    rate_limiter = limiter()
+    assert rate_limiter.admit('alice', 1, 2) == 0
+
+    rate_limiter.refund('alice', 1, 2)
+
+    assert rate_limiter.admit('alice', 1, 2) == 0
+
+
+def test_refund_never_overfills_a_bucket():
+    rate_limiter = limiter()
+    rate_limiter.admit('alice', 1, 1)
+
+    rate_limiter.refund('alice', 1, 5)
+    rate_limiter.refund('bob', 2, 5)
+
+    assert rate_limiter.admit('alice', 1, 2) == 0
+    assert rate_limiter.admit('alice', 1, 1) > 0
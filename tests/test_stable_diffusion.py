@@ -0,0 +1,84 @@
+import asyncio
+import base64
+import io
+import json
+
+import httpx
+from PIL import Image
+
+from lib.image_store import ImageStore
+from lib.stable_diffusion import GenerationRequest, StableDiffusion
+
+
+INFOTEXT = ('a cat 8k, high-resolution, photorealistic\n'
+            'Negative prompt: ugly\n'
+            'Steps: 20, Sampler: Euler a, CFG scale: 7.0, Seed: 1234, Size: 512x512, '
+            'Model hash: abc123, Model: sd15, Version: v1.9.0')
+
+
+def png(color: str) -> str:
+    output = io.BytesIO()
+    Image.new('RGB', (8, 8), color).save(output, format='PNG')
+    return base64.b64encode(output.getvalue()).decode('ascii')
+
+
+def render(info: dict, count: int = 1) -> list:
+    '''
+    Run a request against a mocked txt2img endpoint.
+    '''
+    def respond(request: httpx.Request) -> httpx.Response:
+        assert request.url.path == '/sdapi/v1/txt2img'
+        return httpx.Response(200, json={
+            'images': [png('red'), png('blue')][:count],
+            'parameters': json.loads(request.content),
+            'info': json.dumps(info),
+        })
+
+    async def run():
+        sd = StableDiffusion('http://sd')
+        await sd.client.aclose()
+        sd.client = httpx.AsyncClient(base_url=sd.url, transport=httpx.MockTransport(respond))
+        try:
+            return await sd.generate(GenerationRequest.new_image('a cat', 20, count, 1234))
+        finally:
+            await sd.close()
+    return asyncio.run(run())
+
+
+def archived_parameters(images: list, directory) -> list:
+    '''
+    The parameters text embedded in each image by the image store.
+    '''
+    async def run():
+        store = ImageStore(str(directory))
+        paths = [store.archive(image) for image in images]
+        await store.close()
+        return [Image.open(directory / path).text['parameters'] for path in paths]
+    return asyncio.run(run())
+
+
+def test_infotexts_are_embedded(tmp_path):
+    images = render({'infotexts': [INFOTEXT, INFOTEXT.replace('Seed: 1234', 'Seed: 1235')]}, count=2)
+
+    assert archived_parameters(images, tmp_path) == [INFOTEXT, INFOTEXT.replace('Seed: 1234', 'Seed: 1235')]
+
+
+def test_infotext_is_assembled_without_infotexts(tmp_path):
+    info = {
+        'prompt': 'a cat 8k, high-resolution, photorealistic',
+        'all_prompts': ['a cat 8k, high-resolution, photorealistic'],
+        'negative_prompt': 'ugly',
+        'all_seeds': [1234],
+        'seed': 1234,
+        'steps': 20,
+        'sampler_name': 'Euler a',
+        'cfg_scale': 7.0,
+        'width': 512,
+        'height': 512,
+        'sd_model_hash': 'abc123',
+        'sd_model_name': 'sd15',
+        'version': 'v1.9.0',
+    }
+    images = render(info)
+
+    assert archived_parameters(images, tmp_path) == [INFOTEXT]